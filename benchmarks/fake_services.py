@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Local stand-in HTTP servers of the Keyrock, API Umbrella, CKAN and Orion
+# endpoints used by the plugin, with configurable latency and call counters
+
+from __future__ import unicode_literals
+
+import json
+import re
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime, timedelta
+from urlparse import urlparse, parse_qs
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients closing their keep-alive connections are expected
+        pass
+
+
+class FakeService(object):
+
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.routes = []
+
+        self._lock = threading.Lock()
+        self.calls = {}
+
+        # Concurrent requests served before answering that the service is overloaded (None for no limit)
+        self.capacity = None
+        self.overload_status = 429
+        self.retry_after = None
+        self._active = 0
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                service._dispatch(self)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def route(self, method, pattern, handler):
+        self.routes.append((method, re.compile(pattern + '$'), handler))
+
+    def _dispatch(self, request):
+        parsed_url = urlparse(request.path)
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+
+        with self._lock:
+            self._active += 1
+            overloaded = self.capacity is not None and self._active > self.capacity
+
+        try:
+            time.sleep(self.latency)
+            self._respond(request, parsed_url, body, overloaded)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _route(self, request, parsed_url, body):
+        for method, pattern, handler in self.routes:
+            match = pattern.match(parsed_url.path)
+            if method == request.command and match:
+                operation = '{} {}'.format(method, pattern.pattern[:-1])
+                return (operation,) + handler(match, parse_qs(parsed_url.query), body)
+
+        return '{} <unknown>'.format(request.command), 404, {}, {'error': 'not found'}
+
+    def _respond(self, request, parsed_url, body, overloaded):
+        if overloaded:
+            operation = '{} <overloaded>'.format(request.command)
+            status, headers, content = self.overload_status, {}, {'error': 'overloaded'}
+
+            if self.retry_after is not None:
+                headers['Retry-After'] = self.retry_after
+        else:
+            operation, status, headers, content = self._route(request, parsed_url, body)
+
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+        # The response is written at once, avoiding delayed ACK stalls on keep-alive connections
+        payload = json.dumps(content).encode('utf-8')
+        lines = [
+            'HTTP/1.1 {} {}'.format(status, request.responses.get(status, ('',))[0]),
+            'Content-Type: application/json',
+            'Content-Length: {}'.format(len(payload))
+        ]
+        lines.extend('{}: {}'.format(header, value) for header, value in headers.items())
+
+        request.wfile.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = {}
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def keyrock(latency=0.0, role='customer'):
+    service = FakeService('keyrock', latency)
+
+    # Role assignments made through the API, per application and user
+    service.assignments = {}
+    lock = threading.Lock()
+
+    def login(match, query, body):
+        expires_at = (datetime.utcnow() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        return 201, {'X-Subject-Token': 'token'}, {'token': {'methods': ['password'], 'expires_at': expires_at}}
+
+    def user_roles(match, query, body):
+        with lock:
+            roles = set(['provider']) | service.assignments.get(match.group(1), {}).get(match.group(2), set())
+        return 200, {}, {'role_user_assignments': [{'role_id': role_id, 'user_id': match.group(2)} for role_id in sorted(roles)]}
+
+    def app_users(match, query, body):
+        with lock:
+            users = service.assignments.get(match.group(1), {})
+            assignments = [
+                {'role_id': role_id, 'user_id': user_id}
+                for user_id, roles in sorted(users.items()) for role_id in sorted(roles)
+            ]
+        return 200, {}, {'role_user_assignments': assignments}
+
+    def roles(match, query, body):
+        return 200, {}, {'roles': [{'id': 'provider', 'name': 'Provider'}, {'id': role + '-id', 'name': role}]}
+
+    def assign(match, query, body):
+        with lock:
+            service.assignments.setdefault(match.group(1), {}).setdefault(match.group(2), set()).add(match.group(3))
+        return 201, {}, {}
+
+    def unassign(match, query, body):
+        with lock:
+            service.assignments.get(match.group(1), {}).get(match.group(2), set()).discard(match.group(3))
+        return 204, {}, {}
+
+    service.route('POST', r'/v3/auth/tokens', login)
+    service.route('GET', r'/v1/applications/([^/]+)/users/([^/]+)/roles', user_roles)
+    service.route('GET', r'/v1/applications/([^/]+)/users', app_users)
+    service.route('GET', r'/v1/applications/([^/]+)/roles', roles)
+    service.route('POST', r'/v1/applications/([^/]+)/users/([^/]+)/roles/([^/]+)', assign)
+    service.route('DELETE', r'/v1/applications/([^/]+)/users/([^/]+)/roles/([^/]+)', unassign)
+    return service
+
+
+def umbrella(latency=0.0, apis=1000):
+    service = FakeService('umbrella', latency)
+
+    api_list = [{
+        'id': 'api-{}'.format(i),
+        'frontend_prefixes': '/api{}/'.format(i),
+        'settings': {'idp_app_id': 'app-{}'.format(i)},
+        'updated_at': '2019-01-01T00:00:{:02d}Z'.format(i % 60)
+    } for i in range(apis)]
+
+    def list_apis(match, query, body):
+        data = api_list
+        if query.get('order[0][dir]') == ['desc']:
+            data = sorted(data, key=lambda api: api['updated_at'], reverse=True)
+
+        if 'search[value]' in query:
+            data = [api for api in data if query['search[value]'][0] in api['frontend_prefixes']]
+
+        start = int(query.get('start', ['0'])[0])
+        length = int(query.get('length', ['100'])[0])
+        return 200, {}, {'recordsTotal': len(api_list), 'recordsFiltered': len(data), 'data': data[start:start + length]}
+
+    # Analytics logs of the API calls, sorted by request time (epoch millis)
+    service.logs = []
+
+    operators = {
+        'equal': lambda field, value: field == value,
+        'begins_with': lambda field, value: field is not None and field.startswith(value),
+        'is_null': lambda field, value: field is None,
+        'greater': lambda field, value: field > value,
+        'greater_or_equal': lambda field, value: field >= value,
+        'less_or_equal': lambda field, value: field <= value
+    }
+
+    def logs(match, query, body):
+        rules = json.loads(query['query'][0])['rules'] if 'query' in query else []
+        data = [log for log in service.logs
+                if all(operators[rule['operator']](log.get(rule['field']), rule['value']) for rule in rules)]
+
+        start = int(query.get('start', ['0'])[0])
+        length = int(query.get('length', ['100'])[0])
+        return 200, {}, {'recordsTotal': len(service.logs), 'recordsFiltered': len(data), 'data': data[start:start + length]}
+
+    service.route('GET', r'/api-umbrella/v1/apis.json', list_apis)
+    service.route('GET', r'/api-umbrella/v1/analytics/logs.json', logs)
+    return service
+
+
+def ckan(latency=0.0):
+    service = FakeService('ckan', latency)
+    datasets = {}
+
+    def find(dataset_id):
+        # Datasets are identified by id or by name
+        for dataset in datasets.values():
+            if dataset_id in (dataset['id'], dataset.get('name')):
+                return dataset
+
+    def create(match, query, body):
+        dataset = json.loads(body)
+
+        with service._lock:
+            if find(dataset.get('name')) is not None:
+                return 409, {}, {'success': False, 'error': {'name': ['That URL is already in use.']}}
+
+            dataset['id'] = 'dataset-{}'.format(len(datasets))
+            datasets[dataset['id']] = dataset
+
+        return 200, {}, {'success': True, 'result': dataset}
+
+    def show(match, query, body):
+        dataset = find(query.get('id', [None])[0] or json.loads(body or '{}').get('id'))
+
+        if dataset is None:
+            return 404, {}, {'success': False, 'error': {'message': 'Not found'}}
+
+        return 200, {}, {'success': True, 'result': dataset}
+
+    def update(match, query, body):
+        dataset = json.loads(body)
+        datasets.setdefault(dataset['id'], {}).update(dataset)
+        return 200, {}, {'success': True, 'result': datasets[dataset['id']]}
+
+    def acquired(match, query, body):
+        return 200, {}, {'success': True}
+
+    service.route('POST', r'/api/3/action/package_create', create)
+    service.route('POST', r'/api/3/action/package_show', show)
+    service.route('POST', r'/api/3/action/package_update', update)
+    service.route('POST', r'/api/3/action/package_patch', update)
+    service.route('POST', r'/api/action/package_acquired', acquired)
+    return service
+
+
+def catalog(latency=0.0):
+    service = FakeService('catalog', latency)
+    specs = {}
+
+    def get_spec(match, query, body):
+        spec = specs.setdefault(match.group(1), {'id': match.group(1), 'productSpecCharacteristic': []})
+        return 200, {}, spec
+
+    def patch_spec(match, query, body):
+        spec = specs.setdefault(match.group(1), {'id': match.group(1), 'productSpecCharacteristic': []})
+        spec.update(json.loads(body))
+        return 200, {}, spec
+
+    path = r'/api/catalogManagement/v2/productSpecification/([^/]+)'
+    service.route('GET', path, get_spec)
+    service.route('PATCH', path, patch_spec)
+    return service
+
+
+def orion(latency=0.0, entities=1000):
+    service = FakeService('orion', latency)
+
+    def list_entities(match, query, body):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['20'])[0])
+
+        entity_type = query.get('type', ['Thing'])[0].split(',')[0]
+        data = [{
+            'id': 'urn:{}:{}'.format(entity_type, i),
+            'type': entity_type,
+            'speed': {'type': 'Number', 'value': i, 'metadata': {}}
+        } for i in range(offset, min(offset + limit, entities))]
+
+        options = query.get('options', [''])[0].split(',')
+        if 'values' in options or 'unique' in options:
+            # Lists of the attribute values, without their names
+            data = [[entity['speed']['value'], {'type': 'Point', 'coordinates': [0, 0]}] for entity in data]
+
+        headers = {}
+        if 'count' in options:
+            headers['Fiware-Total-Count'] = str(entities)
+
+        return 200, headers, data
+
+    # Entities are also served under the API prefix of the Umbrella frontend
+    service.route('GET', r'(?:/[^/]+)*/v2/entities', list_entities)
+    return service
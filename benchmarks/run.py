@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the plugin hooks against local stand-in services. Reports the cold (first call)
+# and warm p50/p99 latencies, the throughput under concurrency and the outbound calls per hook.
+#
+#   python benchmarks/run.py --apis 2000 --latency 20 --iterations 200 --concurrency 16
+
+from __future__ import unicode_literals
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fake_services
+import stubs
+
+HOOKS = ('spec_validation', 'spec_attachment', 'acquisition', 'suspension', 'accounting')
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100.0 * (len(values) - 1))))]
+
+
+def _check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self._args = args
+        self._ids = itertools.count()
+
+        ms = lambda value, default: (value if value is not None else default) / 1000.0
+        self.services = [
+            fake_services.keyrock(ms(args.idm_latency, args.latency)).start(),
+            fake_services.umbrella(ms(args.umbrella_latency, args.latency), apis=args.apis).start(),
+            fake_services.ckan(ms(args.ckan_latency, args.latency)).start(),
+            fake_services.orion(ms(args.orion_latency, args.latency), entities=args.entities).start(),
+            fake_services.catalog(ms(args.catalog_latency, args.latency)).start()
+        ]
+        self.keyrock, self.umbrella, self.ckan, self.orion, self.catalog = self.services
+
+        # The IdM answers that it is overloaded when it gets more concurrent calls than its capacity
+        self.keyrock.capacity = args.idm_capacity
+        self.keyrock.overload_status = args.overload_status
+
+        # The plugin settings are read on import
+        self._data_dir = tempfile.mkdtemp(prefix='ngsi-dataset-bench-')
+        os.environ['BAE_ASSET_DATA_DIR'] = self._data_dir
+        os.environ['BAE_ASSET_IDM_URL'] = self.keyrock.url
+        os.environ['BAE_ASSET_UMBRELLA_URL'] = self.umbrella.url
+
+        django_settings = stubs.DjangoSettings()
+        django_settings.CATALOG = self.catalog.url
+        stubs.install(django_settings)
+
+        import job_queue
+        import ngsi_dataset
+
+        self._queue = job_queue.ckan_queue
+        self.plugin = ngsi_dataset.NGSIDataset(None)
+
+        if args.warmup:
+            # As done in background by the plugin load when CLIENT_WARMUP is enabled
+            import client_registry
+            client_registry.clients.warmup()
+
+        self.provider = stubs.User(name='provider', userprofile=stubs._Model(access_token='provider-token'))
+        stubs.User.objects.objects['provider'] = self.provider
+        stubs.User.objects.objects['customer-org'] = stubs.User(
+            name='customer-org', userprofile=stubs._Model(access_token='customer-token'))
+
+        # The worst case of a linear search is the last registered API
+        self._api = args.apis - 1
+
+        # Calls of the accounted customer over the last 3 days, all of them made in complete hours
+        # so every pull bills them at once
+        self._customer = stubs._Model(username='customer-accounting', email='customer@example.com')
+        last_call = int(time.time() // 3600) * 3600 * 1000 - 1
+        self.umbrella.logs = [{
+            'request_at': last_call - i * 72 * 3600 * 1000 // args.calls,
+            'user_email': self._customer.email,
+            'request_path': '/api{}/v2/entities'.format(self._api),
+            'gatekeeper_denied_code': None
+        } for i in reversed(range(args.calls))]
+
+    def _asset(self, **meta_info):
+        pk = 'asset-{}'.format(next(self._ids))
+        info = {
+            'role': 'customer',
+            'entities': 'Vehicle',
+            'attrs': 'speed',
+            'service': 'tenant',
+            'service_path': '/path'
+        }
+        info.update(meta_info)
+
+        asset = stubs.Resource(
+            pk=pk, provider=self.provider, product_id='product-' + pk, meta_info=info,
+            download_link='{}/api{}/'.format(self.orion.url, self._api))
+
+        stubs.Resource.objects.objects[pk] = asset
+        return asset
+
+    def _order(self):
+        order_id = next(self._ids)
+        return stubs._Model(
+            order_id='order-{}'.format(order_id),
+            customer=stubs._Model(username='customer-{}'.format(order_id), email='c{}@example.com'.format(order_id)),
+            owner_organization=stubs._Model(name='customer-org'))
+
+    def _contract(self):
+        contract_id = next(self._ids)
+        asset = self._asset(app_id='app-{}'.format(self._api))
+        contract = stubs._Model(
+            item_id='item-{}'.format(contract_id), last_usage=None,
+            pricing_model={'pay_per_use': [{'unit': 'api call', 'value': '0.01'}]})
+        order = stubs._Model(order_id='order-{}'.format(contract_id), customer=self._customer)
+
+        return asset, contract, order
+
+    def _billing_cycle(self, i):
+        # Pull of a new contract, repeated as done when the billing fails, and then billed
+        asset, contract, order = self._contract()
+        pull = lambda: self.plugin.get_pending_accounting(asset, contract, order)
+
+        records = pull()
+        _check(sum(record['value'] for record in records) == len(self.umbrella.logs), 'Calls are not accounted')
+        _check(pull() == records, 'The records of a failed billing are not replayed')
+
+        contract.last_usage = datetime.utcnow()
+        _check(pull() == [], 'Billed usage is accounted again')
+
+    def check_accounting(self):
+        # Accounted usage must survive restarts and compactions without being lost or billed twice
+        import usage_ledger
+        import usage_store
+
+        def restart():
+            usage_ledger.usage_ledger.reset()
+            usage_store.usage_store.reset()
+
+        asset, contract, order = self._contract()
+        pull = lambda: self.plugin.get_pending_accounting(asset, contract, order)
+
+        records = pull()
+        restart()
+
+        self.umbrella.reset_calls()
+        _check(pull() == records, 'The records of a failed billing are not replayed after a restart')
+        _check(not self.umbrella.total_calls(), 'The analytics logs are read again by the replay')
+
+        contract.last_usage = datetime.utcnow()
+        restart()
+        _check(pull() == [], 'Billed usage is accounted again after a restart')
+
+        self._check_ledger()
+
+    def _check_ledger(self):
+        # Ledger compacted on every billing and reopened as done by a new process
+        from usage_ledger import UsageLedger
+
+        ledger_dir = os.path.join(self._data_dir, 'ledger-check')
+        open_ledger = lambda: UsageLedger(ledger_dir, compact_ratio=0, compact_min_size=0)
+        record = lambda contract: [(0, 24, {'unit': 'api call', 'value': contract + 1})]
+
+        ledger = open_ledger()
+        for contract in range(10):
+            ledger.append_batch(contract, None, 24, record(contract))
+
+        size = os.path.getsize(os.path.join(ledger_dir, 'usage.ledger'))
+        for contract in range(0, 10, 2):
+            ledger.mark_billed(contract, 1)
+
+        _check(os.path.getsize(os.path.join(ledger_dir, 'usage.ledger')) < size, 'Billed records are not compacted')
+
+        # A worker crashed while appending an entry
+        with open(os.path.join(ledger_dir, 'usage.ledger'), 'ab') as ledger_file:
+            ledger_file.write(struct.pack(str('<II'), 100, 0) + b'{"type": "rec')
+
+        reopened = open_ledger()
+        for contract in range(10):
+            pending = reopened.get_pending(contract)
+
+            if contract % 2:
+                _check(pending['records'] == [record(contract)[0][2]], 'Unbilled records are lost')
+            else:
+                _check(pending is None, 'Billed records are pending again')
+
+            _check(reopened.append_batch(contract, None, 24, record(contract)) == [], 'Records are saved twice')
+
+        # The incomplete entry is discarded by the next append
+        _check(reopened.append_batch(10, None, 24, record(10)) == [record(10)[0][2]], 'Records are not saved')
+        _check(open_ledger().get_pending(10)['records'] == [record(10)[0][2]], 'Records appended after a crash are lost')
+
+        for instance in (ledger, reopened):
+            instance.reset()
+
+    def _dataset_asset(self):
+        return self._asset(
+            app_id='app-{}'.format(self._api), ckan_url=self.ckan.url + '/', dataset_id='dataset-0')
+
+    def hook(self, name):
+        plugin = self.plugin
+
+        if name == 'spec_validation':
+            return lambda i: plugin.on_post_product_spec_validation(self.provider, self._asset())
+
+        if name == 'spec_attachment':
+            # Dataset names are unique in CKAN
+            def attach(i):
+                asset = self._asset(ckan_url=self.ckan.url + '/')
+                plugin.on_post_product_spec_attachment(asset, None, {
+                    'id': 'spec-{}'.format(asset.pk),
+                    'name': 'Dataset {}'.format(asset.pk),
+                    'productSpecCharacteristic': []
+                })
+
+            return attach
+
+        if name == 'acquisition':
+            return lambda i: plugin.on_product_acquisition(self._dataset_asset(), None, self._order())
+
+        if name == 'suspension':
+            return lambda i: plugin.on_product_suspension(self._dataset_asset(), None, self._order())
+
+        if name == 'accounting':
+            return self._billing_cycle
+
+    def _drain_jobs(self, timeout=60):
+        # CKAN calls run in background, they are included in the calls of the hook
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self._queue.get_jobs('pending') and not self._queue.get_jobs('running'):
+                return
+
+            time.sleep(0.05)
+
+    def _reset_calls(self):
+        for service in self.services:
+            service.reset_calls()
+
+    def _collect_calls(self, runs):
+        return dict((service.name, service.total_calls() / float(runs)) for service in self.services)
+
+    def measure(self, name):
+        hook = self.hook(name)
+        iterations = self._args.iterations
+
+        # Cold call, including the login and the loading of caches and connections
+        self._reset_calls()
+        start = time.time()
+        hook(0)
+        cold = time.time() - start
+        self._drain_jobs()
+        cold_calls = self._collect_calls(1)
+
+        self._reset_calls()
+        latencies = []
+        for i in range(1, iterations + 1):
+            start = time.time()
+            hook(i)
+            latencies.append(time.time() - start)
+
+        self._drain_jobs()
+        calls = self._collect_calls(iterations)
+
+        pool = ThreadPool(self._args.concurrency)
+        start = time.time()
+        try:
+            pool.map(hook, range(iterations))
+        finally:
+            pool.close()
+            pool.join()
+
+        throughput = iterations / (time.time() - start)
+        self._drain_jobs()
+
+        return {
+            'hook': name,
+            'cold_ms': cold * 1000,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'throughput': throughput,
+            'cold_calls': cold_calls,
+            'calls': calls
+        }
+
+    def close(self):
+        # Closing the pooled connections lets the fake servers finish their request threads
+        import http_client
+        http_client.session_pool.close()
+
+        for service in self.services:
+            service.stop()
+
+        shutil.rmtree(self._data_dir, ignore_errors=True)
+
+
+def _format_calls(calls):
+    return ' '.join('{}={:.2f}'.format(service, count) for service, count in sorted(calls.items()) if count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the NGSI Dataset plugin hooks')
+    parser.add_argument('--hooks', nargs='+', choices=HOOKS, default=list(HOOKS))
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--apis', type=int, default=1000, help='APIs registered in API Umbrella')
+    parser.add_argument('--entities', type=int, default=1000, help='Entities available in Orion')
+    parser.add_argument('--calls', type=int, default=2000, help='API calls of the accounted customer')
+    parser.add_argument('--latency', type=float, default=5, help='Latency (ms) of every service')
+    parser.add_argument('--idm-latency', type=float)
+    parser.add_argument('--umbrella-latency', type=float)
+    parser.add_argument('--ckan-latency', type=float)
+    parser.add_argument('--orion-latency', type=float)
+    parser.add_argument('--catalog-latency', type=float)
+    parser.add_argument('--idm-capacity', type=int, help='Concurrent calls served by the IdM before overloading')
+    parser.add_argument('--overload-status', type=int, choices=(429, 503), default=429,
+                        help='Status answered by the overloaded IdM')
+    parser.add_argument('--warmup', action='store_true', help='Warm up the clients before measuring')
+    parser.add_argument('--json', help='File where the results are saved')
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args)
+    results = []
+    try:
+        print('{:<16} {:>9} {:>9} {:>9} {:>10}  {}'.format('hook', 'cold ms', 'p50 ms', 'p99 ms', 'ops/s', 'calls/hook (cold)'))
+
+        for name in args.hooks:
+            result = benchmark.measure(name)
+            results.append(result)
+
+            print('{hook:<16} {cold_ms:>9.1f} {p50_ms:>9.1f} {p99_ms:>9.1f} {throughput:>10.1f}  '.format(**result) +
+                  '{} ({})'.format(_format_calls(result['calls']), _format_calls(result['cold_calls'])))
+
+        if 'accounting' in args.hooks:
+            benchmark.check_accounting()
+            print('Accounting replay, restart and compaction checks passed')
+    finally:
+        benchmark.close()
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
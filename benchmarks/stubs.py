@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Minimal stand-ins of the Django and wstore modules used by the plugin, so the
+# hooks can be driven outside of a Business API Ecosystem deployment
+
+from __future__ import unicode_literals
+
+import sys
+import types
+
+
+class PluginError(Exception):
+
+    def __init__(self, value):
+        super(PluginError, self).__init__(value)
+        self.value = value
+
+
+class PermissionDenied(Exception):
+    pass
+
+
+class Plugin(object):
+
+    def __init__(self, plugin_model):
+        self._model = plugin_model
+
+
+class _Manager(object):
+
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, pk=None, name=None):
+        return self.objects[pk if pk is not None else name]
+
+
+class _Model(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def save(self):
+        pass
+
+
+class Resource(_Model):
+    objects = _Manager()
+
+    def get_url(self):
+        return self.download_link
+
+
+class User(_Model):
+    objects = _Manager()
+
+
+class Offering(_Model):
+    objects = _Manager()
+
+
+class Order(_Model):
+    objects = _Manager()
+
+
+class DjangoSettings(object):
+    VERIFY_REQUESTS = False
+    SITE = 'http://localhost:8004/'
+    CATALOG = 'http://localhost:8080/DSProductCatalog'
+    NOTIF_CERT_FILE = None
+    NOTIF_CERT_KEY_FILE = None
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(str(name))
+    module.__dict__.update(attrs)
+    sys.modules[str(name)] = module
+    return module
+
+
+def install(django_settings=None):
+    settings = django_settings or DjangoSettings()
+
+    _module('django')
+    _module('django.conf', settings=settings)
+    _module('django.core')
+    _module('django.core.exceptions', PermissionDenied=PermissionDenied)
+
+    _module('wstore')
+    _module('wstore.models', User=User)
+    _module('wstore.ordering')
+    _module('wstore.ordering.models', Offering=Offering, Order=Order)
+    _module('wstore.asset_manager')
+    _module('wstore.asset_manager.models', Resource=Resource)
+    _module('wstore.asset_manager.resource_plugins')
+    _module('wstore.asset_manager.resource_plugins.plugin', Plugin=Plugin)
+    _module('wstore.asset_manager.resource_plugins.plugin_error', PluginError=PluginError)
+
+    return settings
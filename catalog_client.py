@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import requests
+import threading
+import time
+
+from django.conf import settings as django_settings
+
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
+
+import http_client
+import metrics
+from settings import CATALOG_SPEC_CACHE_TTL
+
+
+# Process wide cache of the last known characteristics of the product specs
+class SpecCache(object):
+
+    def __init__(self, ttl=CATALOG_SPEC_CACHE_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._specs = {}
+
+    def get(self, spec_id):
+        with self._lock:
+            entry = self._specs.get(spec_id)
+
+            if entry is None or time.time() >= entry[0]:
+                return None
+
+            return entry[1]
+
+    def set(self, spec_id, characteristics):
+        with self._lock:
+            self._specs[spec_id] = (time.time() + self._ttl, characteristics)
+
+    def invalidate(self, spec_id=None):
+        with self._lock:
+            if spec_id is None:
+                self._specs = {}
+            else:
+                self._specs.pop(spec_id, None)
+
+    def reset(self):
+        self._lock = threading.Lock()
+
+
+spec_cache = SpecCache()
+
+
+class CatalogClient(object):
+
+    def __init__(self):
+        catalog = django_settings.CATALOG
+        if not catalog.endswith('/'):
+            catalog = catalog + '/'
+
+        self._url = catalog + 'api/catalogManagement/v2/productSpecification/'
+
+    def _request(self, operation, method, spec_id, err_msg, **kwargs):
+        with metrics.labels(service='catalog', operation=operation):
+            try:
+                resp = method(self._url + spec_id, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                raise PluginError('The product catalog is not responding')
+
+        if resp.status_code != 200:
+            raise PluginError(err_msg)
+
+        spec = resp.json()
+        spec_cache.set(spec_id, spec.get('productSpecCharacteristic') or [])
+        return spec
+
+    def get_spec(self, spec_id):
+        return self._request(
+            'get_spec', http_client.get, spec_id, 'It has not been possible to retrieve the product specification')
+
+    def patch_spec(self, spec_id, fields):
+        # Only the provided fields are sent, the rest of the spec is kept by the catalog
+        return self._request(
+            'patch_spec', http_client.patch, spec_id, 'It has not been possible to update the product specification',
+            json=fields)
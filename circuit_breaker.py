@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import deque
+from urlparse import urlparse
+
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
+
+import metrics
+from settings import CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW, CIRCUIT_OPEN_SECONDS, \
+    CIRCUIT_HALF_OPEN_CALLS
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+registry = metrics.registry
+registry.describe('ngsi_dataset_circuit_opened_total', 'counter', 'Times a backend circuit breaker has opened')
+registry.describe('ngsi_dataset_circuit_rejected_total', 'counter', 'Calls rejected by an open circuit breaker')
+
+
+class CircuitOpenError(PluginError):
+    pass
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failure_rate=CIRCUIT_FAILURE_RATE, min_calls=CIRCUIT_MIN_CALLS,
+                 window=CIRCUIT_WINDOW, open_seconds=CIRCUIT_OPEN_SECONDS, half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+
+        self.name = name
+        self._failure_rate = failure_rate
+        self._min_calls = min_calls
+        self._open_seconds = open_seconds
+        self._half_open_calls = half_open_calls
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def _reject(self):
+        registry.inc('ngsi_dataset_circuit_rejected_total', {'backend': self.name})
+        raise CircuitOpenError('The {} service is not available, please try again later'.format(self.name))
+
+    def before_call(self):
+        with self._lock:
+            if self._state == OPEN:
+                if time.time() < self._opened_at + self._open_seconds:
+                    self._reject()
+
+                # Let some calls probe whether the backend has recovered
+                self._state = HALF_OPEN
+                self._probes = 0
+
+            if self._state == HALF_OPEN:
+                if self._probes >= self._half_open_calls:
+                    self._reject()
+
+                self._probes += 1
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.time()
+        registry.inc('ngsi_dataset_circuit_opened_total', {'backend': self.name})
+
+    def record(self, success):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if success:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+
+            if self._state == CLOSED and len(self._outcomes) >= self._min_calls and \
+                    failures >= self._failure_rate * len(self._outcomes):
+                self._open()
+                self._outcomes.clear()
+
+
+class BreakerRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, url, name=None):
+        # One breaker per backend host and service, as services can be reached through the same host,
+        # e.g. the Orion queries published behind API Umbrella
+        parsed_url = urlparse(url)
+        name = name or parsed_url.netloc
+        key = (parsed_url.scheme, parsed_url.netloc, name)
+
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(name)
+
+            return self._breakers[key]
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+
+breakers = BreakerRegistry()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from urlparse import urljoin
+
+from django.conf import settings as django_settings
+
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
+
+import http_client
+import metrics
+
+
+class CKANClient(object):
+
+    def __init__(self, url, token_loader=None):
+        self._url = url if url.endswith('/') else url + '/'
+
+        # The provider access token is loaded once per client, which lives for a hook or job
+        self._token_loader = token_loader
+        self._token = None
+
+    def _get_token(self):
+        if self._token is None:
+            self._token = self._token_loader()
+
+        return self._token
+
+    def _post(self, action, data):
+        url = self._url + 'api/3/action/' + action
+
+        token = self._get_token()
+        with metrics.labels(service='ckan', operation=action):
+            return http_client.post(url, json=data, headers={
+                'Authorization': 'Bearer ' + token
+            })
+
+    def _action(self, action, data, err_msg):
+        resp = self._post(action, data)
+
+        if resp.status_code != 200:
+            raise PluginError(err_msg)
+
+        return resp.json()['result']
+
+    def get_dataset(self, dataset_id):
+        # Datasets can be retrieved by id or by name, returns None if it does not exist
+        resp = self._post('package_show', {'id': dataset_id})
+
+        if resp.status_code == 404:
+            return None
+
+        if resp.status_code != 200:
+            raise PluginError('It has not been possible to retrieve the CKAN dataset')
+
+        return resp.json()['result']
+
+    def create_dataset(self, dataset_info):
+        return self._action('package_create', dataset_info, 'It had not being possible to create CKAN dataset')
+
+    def patch_dataset(self, dataset_id, fields):
+        # Only the provided fields are sent, the rest of the dataset is kept by CKAN
+        data = dict(fields)
+        data['id'] = dataset_id
+
+        return self._action('package_patch', data, 'It has not been posible to update the CKAN dataset')
+
+    def patch_datasets(self, updates):
+        # Applies several (dataset_id, fields) updates in one pass over the same
+        # connection and token, returning the result of each one
+        results = []
+        for dataset_id, fields in updates:
+            try:
+                self.patch_dataset(dataset_id, fields)
+                results.append({'success': True, 'error': None})
+            except Exception as e:
+                results.append({'success': False, 'error': '{}'.format(e)})
+
+        return results
+
+    def notify_acquisition(self, dataset_id, customer):
+        notification_url = urljoin(self._url, '/api/action/package_acquired')
+        dataset_url = urljoin(self._url, '/dataset/{}'.format(dataset_id))
+
+        # Build notification data
+        data = {
+            'customer_name': customer,
+            'resources': [{
+                'url': dataset_url
+            }]
+        }
+
+        # Notify the dataset acquisition to CKAN
+        headers = {'Content-type': 'application/json'}
+        with metrics.labels(service='ckan', operation='package_acquired'):
+            response = http_client.post(
+                notification_url,
+                json=data,
+                headers=headers,
+                verify=django_settings.VERIFY_REQUESTS,
+                cert=(django_settings.NOTIF_CERT_FILE, django_settings.NOTIF_CERT_KEY_FILE)
+            )
+        response.raise_for_status()
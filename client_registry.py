@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+
+import metrics
+from catalog_client import spec_cache
+from circuit_breaker import breakers
+from concurrency import flights, run_concurrently
+from http_client import session_pool
+from keyrock_client import KeyrockClient, assignment_cache, read_limiter, role_cache, token_store, write_limiter
+from umbrella_client import UmbrellaClient
+from umbrella_index import api_index
+from usage_ledger import usage_ledger
+from usage_store import usage_store
+from settings import CLIENT_WARMUP
+
+logger = logging.getLogger(__name__)
+
+
+# Per process registry of the IdM and API Umbrella clients, shared by all the hooks. When the
+# process is forked (e.g. by gunicorn or uwsgi workers) the child one starts with its own
+# connections and tokens, as the ones of the parent process cannot be shared
+class ClientRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._initialized = False
+        self._keyrock = None
+        self._umbrella = None
+
+    def _check_fork(self):
+        if self._pid == os.getpid():
+            return
+
+        # Locks may have been held by threads that do not exist in this process, and connections,
+        # tokens and file locks are shared with the parent one
+        self._lock = threading.Lock()
+        for state in (session_pool, breakers, token_store, role_cache, assignment_cache, read_limiter, write_limiter,
+                      spec_cache, flights, api_index, usage_store, usage_ledger, metrics.registry):
+            state.reset()
+
+        self._initialized = False
+        self._keyrock = None
+        self._umbrella = None
+        self._pid = os.getpid()
+
+    def initialize(self, warmup=CLIENT_WARMUP):
+        # Plugin instances are created for every hook, only the first one of the process is considered
+        self._check_fork()
+
+        with self._lock:
+            if self._initialized:
+                return
+
+            self._initialized = True
+
+        if warmup:
+            thread = threading.Thread(target=self.warmup)
+            thread.daemon = True
+            thread.start()
+
+    def warmup(self):
+        # Logs in the IdM and loads the API Umbrella index, opening the connections to both
+        # services, so the first hook is as fast as the following ones
+        try:
+            run_concurrently(self.get_keyrock, lambda: api_index.refresh(self.get_umbrella()))
+        except Exception as e:
+            logger.warning('The clients could not be warmed up: %s', e)
+
+    def get_keyrock(self):
+        self._check_fork()
+
+        if self._keyrock is None:
+            # The login is made out of the lock, concurrent callers share it through the token store
+            client = KeyrockClient()
+
+            with self._lock:
+                if self._keyrock is None:
+                    self._keyrock = client
+
+        return self._keyrock
+
+    def get_umbrella(self):
+        self._check_fork()
+
+        with self._lock:
+            if self._umbrella is None:
+                self._umbrella = UmbrellaClient()
+
+            return self._umbrella
+
+
+clients = ClientRegistry()
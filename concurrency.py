@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import threading
+
+import metrics
+
+
+def run_concurrently(*calls):
+    # Runs the given callables in parallel threads returning their results in order. If any of
+    # them fails its error is raised straight away, without waiting for the remaining ones
+    results = [None] * len(calls)
+    state = {
+        'pending': len(calls),
+        'error': None
+    }
+    condition = threading.Condition()
+
+    def run(position, call):
+        try:
+            result = call()
+            error = None
+        except Exception as e:
+            error = e
+
+        with condition:
+            if error is not None and state['error'] is None:
+                state['error'] = error
+
+            results[position] = result if error is None else None
+            state['pending'] -= 1
+            condition.notify()
+
+    for position, call in enumerate(calls):
+        thread = threading.Thread(target=metrics.bind(run), args=(position, call))
+        thread.daemon = True
+        thread.start()
+
+    with condition:
+        while state['pending'] and state['error'] is None:
+            condition.wait()
+
+    if state['error'] is not None:
+        raise state['error']
+
+    return results
+
+
+metrics.registry.describe(
+    'ngsi_dataset_coalesced_calls_total', 'counter', 'Calls served by an identical concurrent in-flight request')
+
+
+class _Call(object):
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Coalesces concurrent calls for the same key, so only the first caller makes the remote
+# request and the rest wait for it sharing its result or error
+class SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def reset(self):
+        # Calls in flight in the parent process will never complete in the child one
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.registry.inc('ngsi_dataset_coalesced_calls_total', {'operation': key[0]})
+            call.event.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.event.set()
+
+        return call.result
+
+
+flights = SingleFlight()
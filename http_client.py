@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import random
+import requests
+import threading
+import time
+from urlparse import urlparse
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import metrics
+from circuit_breaker import breakers
+from settings import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, \
+    HTTP_MAX_RETRIES, HTTP_BACKOFF_FACTOR
+
+
+# Only requests that can be safely repeated are retried
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+RETRY_STATUS = (502, 503, 504)
+
+
+class JitteredRetry(Retry):
+
+    def get_backoff_time(self):
+        # Full jitter, so concurrent workers retrying against the same host do not synchronize
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff)
+
+
+def _build_retry(status_retries=True):
+    # Backends with their own rate limiting handle the overload answers, so only connection
+    # errors are retried for them
+    params = {
+        'total': HTTP_MAX_RETRIES,
+        'backoff_factor': HTTP_BACKOFF_FACTOR,
+        'status_forcelist': RETRY_STATUS if status_retries else (),
+        'respect_retry_after_header': status_retries,
+        'raise_on_status': False
+    }
+
+    try:
+        return JitteredRetry(allowed_methods=IDEMPOTENT_METHODS, **params)
+    except TypeError:
+        # urllib3 < 1.26
+        return JitteredRetry(method_whitelist=IDEMPOTENT_METHODS, **params)
+
+
+class PooledSession(requests.Session):
+
+    def __init__(self, status_retries=True):
+        super(PooledSession, self).__init__()
+
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS,
+            pool_maxsize=HTTP_POOL_MAXSIZE,
+            max_retries=_build_retry(status_retries))
+
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+
+class SessionPool(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get_session(self, url, status_retries=True, verify=None, cert=None):
+        # Kept alive connections are reused with the TLS settings they were opened with, so calls
+        # with different certificate verification or client certificate do not share them
+        parsed_url = urlparse(url)
+        key = (parsed_url.scheme, parsed_url.netloc, status_retries, True if verify is None else verify,
+               tuple(cert) if isinstance(cert, (list, tuple)) else cert)
+
+        with self._lock:
+            if key not in self._sessions:
+                self._sessions[key] = PooledSession(status_retries)
+
+            return self._sessions[key]
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+
+            self._sessions = {}
+
+    def reset(self):
+        # After a fork the connections belong to the parent process, they are left to it
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+
+session_pool = SessionPool()
+
+
+# Drop-in replacements of the requests module functions using the shared keep-alive sessions
+def request(method, url, status_retries=True, **kwargs):
+    # Calls to unresponsive backends fail fast instead of blocking the worker
+    breaker = breakers.get(url, metrics.current_labels().get('service'))
+    breaker.before_call()
+
+    start = time.time()
+    try:
+        response = session_pool.get_session(
+            url, status_retries, kwargs.get('verify'), kwargs.get('cert')).request(method, url, **kwargs)
+    except Exception as e:
+        breaker.record(not isinstance(e, requests.RequestException))
+        metrics.record_request(method, url, start, error=e)
+        raise
+
+    # Overload answers of backends limited by the caller are retried by its limiter, the backend is not failing
+    overloaded = not status_retries and response.status_code in (429, 503)
+    breaker.record(response.status_code < 500 or overloaded)
+    metrics.record_request(method, url, start, response=response)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request('PATCH', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
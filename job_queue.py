@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+from settings import DATA_DIR, CKAN_QUEUE_WORKERS, CKAN_QUEUE_MAX_ATTEMPTS, CKAN_QUEUE_RETRY_DELAY, \
+    CKAN_QUEUE_POLL_INTERVAL, CKAN_QUEUE_JOB_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+# Raised by handlers whose job cannot run yet, e.g. as it depends on another job. The job is
+# scheduled again without counting an attempt
+class RetryLater(Exception):
+    pass
+
+
+def _dict_factory(cursor, row):
+    return dict((column[0], value) for column, value in zip(cursor.description, row))
+
+
+# Durable queue of background jobs stored in a local SQLite database. Jobs are identified by an
+# idempotency key, so enqueueing an already known job has no effect, and failed executions are
+# retried with exponential backoff until the maximum number of attempts is reached
+class JobQueue(object):
+
+    def __init__(self, db_path, workers=CKAN_QUEUE_WORKERS, max_attempts=CKAN_QUEUE_MAX_ATTEMPTS,
+                 retry_delay=CKAN_QUEUE_RETRY_DELAY, poll_interval=CKAN_QUEUE_POLL_INTERVAL,
+                 job_timeout=CKAN_QUEUE_JOB_TIMEOUT):
+
+        self._db_path = db_path
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._poll_interval = poll_interval
+        self._job_timeout = job_timeout
+
+        self._handlers = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        db_dir = os.path.dirname(self._db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            try:
+                os.makedirs(db_dir)
+            except OSError:
+                # Created by another worker
+                if not os.path.isdir(db_dir):
+                    raise
+
+        # Transactions are managed explicitly, workers of other processes share the database
+        conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+        conn.row_factory = _dict_factory
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, operation TEXT NOT NULL, payload TEXT NOT NULL, '
+            'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_run REAL NOT NULL, last_error TEXT, '
+            'created REAL NOT NULL, updated REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_run)')
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def register(self, operation, handler):
+        self._handlers[operation] = handler
+
+    def start(self):
+        # Threads do not survive a fork, so every process starts its own workers. Once started they
+        # also run the jobs left pending or running by a previous process
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._work, name='job-queue-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+
+    def enqueue(self, key, operation, payload):
+        now = time.time()
+        conn = self._connection()
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO jobs (key, operation, payload, status, next_run, created, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (key, operation, json.dumps(payload), PENDING, now, now, now))
+
+        self.start()
+        self._wakeup.set()
+
+        return cursor.rowcount > 0
+
+    def _claim(self):
+        now = time.time()
+        conn = self._connection()
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Running jobs not updated within the timeout belong to a dead worker
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE (status = ? AND next_run <= ?) OR (status = ? AND updated < ?) '
+                'ORDER BY next_run LIMIT 1', (PENDING, now, RUNNING, now - self._job_timeout)).fetchone()
+
+            if row is not None:
+                conn.execute('UPDATE jobs SET status = ?, updated = ? WHERE key = ?', (RUNNING, now, row['key']))
+
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        return row
+
+    def _run(self, job):
+        conn = self._connection()
+        try:
+            handler = metrics.hook('job_' + job['operation'])(self._handlers[job['operation']])
+            handler(json.loads(job['payload']))
+        except RetryLater as e:
+            conn.execute(
+                'UPDATE jobs SET status = ?, next_run = ?, last_error = ?, updated = ? WHERE key = ?',
+                (PENDING, time.time() + self._retry_delay, '{}'.format(e), time.time(), job['key']))
+        except Exception as e:
+            attempts = job['attempts'] + 1
+            status = FAILED if attempts >= self._max_attempts else PENDING
+
+            # Exponential backoff with jitter
+            next_run = time.time() + self._retry_delay * (2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+
+            logger.warning('Job %s failed (attempt %d): %s', job['key'], attempts, e)
+            conn.execute(
+                'UPDATE jobs SET status = ?, attempts = ?, next_run = ?, last_error = ?, updated = ? WHERE key = ?',
+                (status, attempts, next_run, '{}'.format(e), time.time(), job['key']))
+        else:
+            conn.execute(
+                'UPDATE jobs SET status = ?, attempts = ?, last_error = NULL, updated = ? WHERE key = ?',
+                (DONE, job['attempts'] + 1, time.time(), job['key']))
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception:
+                logger.exception('Error reading the job queue')
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._run(job)
+            except Exception:
+                # The job is claimed again once its timeout expires
+                logger.exception('Error updating the job %s', job['key'])
+
+    def get_jobs(self, status=None):
+        query = 'SELECT * FROM jobs'
+        params = ()
+        if status is not None:
+            query += ' WHERE status = ?'
+            params = (status,)
+
+        return self._connection().execute(query + ' ORDER BY created', params).fetchall()
+
+    def get_job(self, key):
+        return self._connection().execute('SELECT * FROM jobs WHERE key = ?', (key,)).fetchone()
+
+    def replay(self, key=None):
+        # Schedules again the given failed job, or all the failed jobs if no key is provided
+        query = 'UPDATE jobs SET status = ?, attempts = 0, next_run = ?, updated = ? WHERE status = ?'
+        params = (PENDING, time.time(), time.time(), FAILED)
+
+        if key is not None:
+            query += ' AND key = ?'
+            params += (key,)
+
+        replayed = self._connection().execute(query, params).rowcount
+        self._wakeup.set()
+
+        return replayed
+
+
+ckan_queue = JobQueue(os.path.join(DATA_DIR, 'ckan_jobs.db'))
+
+
+if __name__ == '__main__':
+    # Inspection of the CKAN job queue, e.g. python job_queue.py list failed
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+
+    if command == 'list':
+        for job in ckan_queue.get_jobs(sys.argv[2] if len(sys.argv) > 2 else None):
+            print('{key}\t{operation}\t{status}\t{attempts}\t{last_error}'.format(**job))
+
+    elif command == 'replay':
+        print('{} jobs replayed'.format(ckan_queue.replay(sys.argv[2] if len(sys.argv) > 2 else None)))
+
+    else:
+        sys.exit('Usage: job_queue.py list [status] | replay [key]')
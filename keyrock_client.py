@@ -19,7 +19,13 @@
 
 from __future__ import unicode_literals
 
+import calendar
+import random
 import requests
+import threading
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
 from django.conf import settings as django_settings
@@ -27,13 +33,37 @@ from django.core.exceptions import PermissionDenied
 
 from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 
-from settings import IDM_URL, IDM_PASSWORD, IDM_USER
+import http_client
+import metrics
+from concurrency import flights
+from rate_limiter import AdaptiveLimiter, parse_retry_after
+from settings import IDM_URL, IDM_PASSWORD, IDM_USER, IDM_TOKEN_REFRESH_MARGIN, IDM_TOKEN_DEFAULT_TTL, \
+    IDM_ROLES_CACHE_TTL, IDM_BULK_WORKERS, IDM_ASSIGNMENTS_CACHE_TTL, IDM_READ_RATE, IDM_READ_BURST, \
+    IDM_READ_CONCURRENCY, IDM_WRITE_RATE, IDM_WRITE_BURST, IDM_WRITE_CONCURRENCY, IDM_OVERLOAD_RETRIES, \
+    IDM_RATE_MAX_WAIT, HTTP_BACKOFF_FACTOR
 
 
-class KeyrockClient(object):
+metrics.registry.describe(
+    'ngsi_dataset_skipped_role_updates_total', 'counter', 'Role updates skipped as the assignment was already applied')
+
+
+def _parse_expiry(expires_at):
+    # Keystone dates are ISO 8601 UTC timestamps, e.g. 2019-04-08T11:21:22.000Z
+    try:
+        date = datetime.strptime(expires_at.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+    except (AttributeError, ValueError):
+        return None
+
+    return calendar.timegm(date.timetuple())
+
+
+# Process wide store of the IdM admin token, shared by all the KeyrockClient instances
+class TokenStore(object):
 
     def __init__(self):
-        self._login()
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
 
     def _login(self):
         body = {
@@ -42,71 +72,470 @@ class KeyrockClient(object):
         }
 
         url = IDM_URL + '/v3/auth/tokens'
-        response = requests.post(url, json=body, verify=django_settings.VERIFY_REQUESTS)
+        with metrics.labels(service='keyrock', operation='login'):
+            response = http_client.post(url, json=body, verify=django_settings.VERIFY_REQUESTS)
 
         response.raise_for_status()
-        self._auth_token = response.headers['x-subject-token']
+        token = response.headers['x-subject-token']
+
+        expires_at = None
+        try:
+            expires_at = _parse_expiry(response.json()['token']['expires_at'])
+        except (ValueError, KeyError, TypeError):
+            pass
+
+        if expires_at is None:
+            expires_at = time.time() + IDM_TOKEN_DEFAULT_TTL
+
+        return token, expires_at
+
+    def get_token(self, expired=None):
+        # The lock is held during the login so concurrent callers wait for a single refresh
+        with self._lock:
+            if self._token is None or self._token == expired or \
+                    time.time() >= self._expires_at - IDM_TOKEN_REFRESH_MARGIN:
+
+                self._token, self._expires_at = self._login()
+
+            return self._token
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+
+    def reset(self):
+        # Every process logs in with its own token
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+
+
+token_store = TokenStore()
+
+
+# Process wide cache of the role name (lowercase) to role id mapping of each IdM application
+class RoleCache(object):
+
+    def __init__(self, ttl=IDM_ROLES_CACHE_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._roles = {}
+
+    def get(self, app_id):
+        with self._lock:
+            entry = self._roles.get(app_id)
+
+            if entry is None or time.time() >= entry[0]:
+                return None
+
+            return entry[1]
+
+    def set(self, app_id, roles):
+        with self._lock:
+            self._roles[app_id] = (time.time() + self._ttl, roles)
+
+    def invalidate(self, app_id=None):
+        with self._lock:
+            if app_id is None:
+                self._roles = {}
+            else:
+                self._roles.pop(app_id, None)
+
+    def reset(self):
+        # The cached roles are kept, only the lock may be held by a thread of the parent process
+        self._lock = threading.Lock()
+
+
+role_cache = RoleCache()
+
+
+# Process wide cache of the role ids assigned to the users of each IdM application. Entries are
+# filled from the user or application assignment listings and kept up to date by our own writes
+class AssignmentCache(object):
+
+    def __init__(self, ttl=IDM_ASSIGNMENTS_CACHE_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._apps = {}
+
+    def _get_app(self, app_id):
+        return self._apps.setdefault(app_id, {'expires': 0, 'users': {}})
+
+    def get(self, app_id, user_id):
+        with self._lock:
+            app = self._apps.get(app_id)
+            if app is None:
+                return None
+
+            now = time.time()
+            entry = app['users'].get(user_id)
+
+            if entry is not None and now < entry[0]:
+                return entry[1]
+
+            # A complete listing of the application tells that the user has no roles
+            if entry is None and now < app['expires']:
+                return set()
+
+            return None
+
+    def has_app(self, app_id):
+        with self._lock:
+            app = self._apps.get(app_id)
+            return app is not None and time.time() < app['expires']
+
+    def set_user(self, app_id, user_id, roles):
+        with self._lock:
+            self._get_app(app_id)['users'][user_id] = (time.time() + self._ttl, set(roles))
+
+    def set_app(self, app_id, assignments):
+        expires = time.time() + self._ttl
+
+        with self._lock:
+            self._apps[app_id] = {
+                'expires': expires,
+                'users': {user_id: (expires, set(roles)) for user_id, roles in assignments.items()}
+            }
+
+    def update(self, app_id, user_id, role_id, assigned):
+        with self._lock:
+            app = self._apps.get(app_id)
+            if app is None:
+                return
+
+            now = time.time()
+            entry = app['users'].get(user_id)
+
+            if entry is None or now >= entry[0]:
+                # Only known users are updated, the write does not tell the rest of their roles
+                if entry is not None or now >= app['expires']:
+                    return
+                entry = (app['expires'], set())
+
+            roles = set(entry[1])
+            if assigned:
+                roles.add(role_id)
+            else:
+                roles.discard(role_id)
+
+            app['users'][user_id] = (entry[0], roles)
+
+    def invalidate(self, app_id=None, user_id=None):
+        with self._lock:
+            if app_id is None:
+                self._apps = {}
+            elif user_id is None:
+                self._apps.pop(app_id, None)
+            elif app_id in self._apps:
+                self._apps[app_id]['users'].pop(user_id, None)
+                # The user can no longer be considered without roles by the application listing
+                self._apps[app_id]['expires'] = 0
+
+    def reset(self):
+        self._lock = threading.Lock()
+
+
+assignment_cache = AssignmentCache()
+
+
+# Process wide limits of the calls made to the IdM, role assignments are limited apart from reads
+read_limiter = AdaptiveLimiter(
+    'keyrock', 'read', IDM_READ_RATE, IDM_READ_BURST, IDM_READ_CONCURRENCY, IDM_RATE_MAX_WAIT)
+write_limiter = AdaptiveLimiter(
+    'keyrock', 'write', IDM_WRITE_RATE, IDM_WRITE_BURST, IDM_WRITE_CONCURRENCY, IDM_RATE_MAX_WAIT)
+
+
+class KeyrockClient(object):
+
+    def __init__(self):
+        # Logs in on creation, the token is then renewed by the store before it expires
+        token_store.get_token()
+
+    def _send(self, operation, method, url, headers, **kwargs):
+        limiter = read_limiter if method is http_client.get else write_limiter
+
+        attempt = 0
+        while True:
+            limiter.acquire()
+
+            try:
+                # Overload answers are not retried by the session, they are handled here with the limiter
+                with metrics.labels(service='keyrock', operation=operation):
+                    resp = method(
+                        url, headers=headers, verify=django_settings.VERIFY_REQUESTS, status_retries=False, **kwargs)
+            except requests.Timeout:
+                limiter.release(True)
+                raise
+            except Exception:
+                # Open circuits and local errors tell nothing about the load of the IdM
+                limiter.release(None)
+                raise
+
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+            limiter.release(resp.status_code == 429 or resp.status_code >= 500, retry_after)
+
+            # Calls rejected as the IdM is overloaded are retried once the limiter lets them through,
+            # role assignments can be repeated safely
+            if resp.status_code not in (429, 503) or attempt >= IDM_OVERLOAD_RETRIES:
+                return resp
+
+            if retry_after is None:
+                time.sleep(random.uniform(0, HTTP_BACKOFF_FACTOR * (2 ** attempt)))
+
+            attempt += 1
+
+    def _request(self, operation, method, url, headers=None, **kwargs):
+        # The token is taken from the store on every call, so it is refreshed ahead of its expiration
+        token = token_store.get_token()
+
+        headers = dict(headers or {})
+        headers['X-Auth-Token'] = token
+
+        resp = self._send(operation, method, url, headers, **kwargs)
+
+        if resp.status_code == 401:
+            # The cached token has been revoked or has expired earlier than expected, renew it and retry once
+            headers['X-Auth-Token'] = token_store.get_token(expired=token)
+
+            resp = self._send(operation, method, url, headers, **kwargs)
+
+        return resp
 
     def check_ownership(self, app_id, provider):
-        path = '/v1/applications/{}/users/{}/roles'.format(app_id, provider)
+        # Concurrent checks of the same provider and application share the request
+        flights.do(('check_ownership', app_id, provider), lambda: self._check_ownership(app_id, provider))
+
+    def _check_ownership(self, app_id, provider):
+        if 'provider' not in self._fetch_user_roles(app_id, provider):
+            raise PermissionDenied('You are not the owner of the specified IDM application')
+
+    def _get_user_roles(self, app_id, user_id):
+        roles = assignment_cache.get(app_id, user_id)
+        if roles is not None:
+            return roles
+
+        return flights.do(('get_user_roles', app_id, user_id), lambda: self._fetch_user_roles(app_id, user_id))
+
+    def _fetch_user_roles(self, app_id, user_id):
+        path = '/v1/applications/{}/users/{}/roles'.format(app_id, user_id)
         role_field = 'role_user_assignments'
 
         assingments_url = IDM_URL + path
 
-        resp = requests.get(assingments_url, headers={
-            'X-Auth-Token': self._auth_token
-        }, verify=django_settings.VERIFY_REQUESTS)
-
-        resp.raise_for_status()
-        assingments = resp.json()
+        resp = self._request('get_user_roles', http_client.get, assingments_url)
 
-        for assingment in assingments[role_field]:
-            if assingment['role_id'] == 'provider':
-                break
+        # The IDM answers with not found when the user has no roles in the application
+        if resp.status_code == 404:
+            roles = set()
         else:
-            raise PermissionDenied('You are not the owner of the specified IDM application')
+            resp.raise_for_status()
+            roles = set(assingment['role_id'] for assingment in resp.json()[role_field])
 
-    def check_role(self, app_id, role_name):
+        assignment_cache.set_user(app_id, user_id, roles)
+        return roles
+
+    def _get_roles(self, app_id):
+        roles = role_cache.get(app_id)
+        if roles is not None:
+            return roles
+
+        # Concurrent lookups of the same application roles share the request
+        return flights.do(('get_roles', app_id), lambda: self._fetch_roles(app_id))
+
+    def _fetch_roles(self, app_id):
         # Get available roles
         path = '/v1/applications/{}/roles'.format(app_id)
         roles_url = IDM_URL + path
 
-        resp = requests.get(roles_url, headers={
-            'X-Auth-Token': self._auth_token
-        }, verify=django_settings.VERIFY_REQUESTS)
+        resp = self._request('get_roles', http_client.get, roles_url)
 
-        # Get role id
         resp.raise_for_status()
-        roles = resp.json()
+        roles = {role['name'].lower(): role['id'] for role in resp.json()['roles']}
 
-        for role in roles['roles']:
-            if role['name'].lower() == role_name.lower():
-                role_id = role['id']
-                break
-        else:
+        role_cache.set(app_id, roles)
+        return roles
+
+    def check_role(self, app_id, role_name):
+        cached = role_cache.get(app_id) is not None
+        roles = self._get_roles(app_id)
+
+        if role_name.lower() not in roles and cached:
+            # The role may have been registered after caching the application roles
+            role_cache.invalidate(app_id)
+            roles = self._get_roles(app_id)
+
+        # Get role id
+        if role_name.lower() not in roles:
             raise PluginError('The provided role is not registered in keystone')
 
-        return role_id
+        return roles[role_name.lower()]
+
+    def get_role_assignments(self, app_id):
+        # Returns the ids of the roles assigned to each user of the application
+        path = '/v1/applications/{}/users'.format(app_id)
+        resp = self._request('list_assignments', http_client.get, IDM_URL + path)
+
+        resp.raise_for_status()
+
+        assignments = {}
+        for assignment in resp.json()['role_user_assignments']:
+            assignments.setdefault(assignment['user_id'], set()).add(assignment['role_id'])
+
+        assignment_cache.set_app(app_id, assignments)
+        return assignments
+
+    def reconcile_role(self, app_id, role, users, dry_run=False):
+        # Makes the users holding the role in the application match the given ones, issuing
+        # only the grants and revocations needed. Returns a report of the changes
+        start = time.time()
 
-    def grant_permission(self, app_id, user, role):
-        # Get ids
         role_id = self.check_role(app_id, role)
-        assign_url = IDM_URL + '/v1/applications/{}/users/{}/roles/{}'.format(app_id, user.username, role_id)
+        assignments = self.get_role_assignments(app_id)
+        listed = time.time()
+
+        current = set(user for user, roles in assignments.items() if role_id in roles)
+        users = set(users)
+
+        to_grant = sorted(users - current)
+        to_revoke = sorted(current - users)
+
+        report = {
+            'app_id': app_id,
+            'role': role,
+            'dry_run': dry_run,
+            'expected': len(users),
+            'current': len(current),
+            'granted': to_grant,
+            'revoked': to_revoke,
+            'failed': [],
+            'list_time': listed - start,
+            'apply_time': 0.0
+        }
 
-        resp = requests.post(assign_url, headers={
-            'X-Auth-Token': self._auth_token,
+        if dry_run:
+            return report
+
+        operations = [('grant', app_id, user, role) for user in to_grant] + \
+            [('revoke', app_id, user, role) for user in to_revoke]
+
+        results = self.apply_permissions(operations)
+
+        for (action, app_id, user, role), result in zip(operations, results):
+            if not result['success']:
+                report['failed'].append({'action': action, 'user': user, 'error': result['error']})
+
+        failed = set((failure['action'], failure['user']) for failure in report['failed'])
+        report['granted'] = [user for user in to_grant if ('grant', user) not in failed]
+        report['revoked'] = [user for user in to_revoke if ('revoke', user) not in failed]
+        report['apply_time'] = time.time() - listed
+
+        return report
+
+    def _set_role(self, method, app_id, user, role_id):
+        # Users can be given as BAE users or directly as IDM user ids
+        user_id = getattr(user, 'username', user)
+        assign_url = IDM_URL + '/v1/applications/{}/users/{}/roles/{}'.format(app_id, user_id, role_id)
+
+        operation = 'assign_role' if method is http_client.post else 'remove_role'
+        return self._request(operation, method, assign_url, headers={
             'Content-Type': 'application/json'
-        }, verify=django_settings.VERIFY_REQUESTS)
+        })
 
-        resp.raise_for_status()
+    def _update_role(self, method, app_id, user, role):
+        cached = role_cache.get(app_id) is not None
+        user_id = getattr(user, 'username', user)
+        assign = method is http_client.post
 
-    def revoke_permission(self, app_id, user, role):
+        # Get ids
         role_id = self.check_role(app_id, role)
-        assign_url = IDM_URL + '/v1/applications/{}/users/{}/roles/{}'.format(app_id, user.username, role_id)
 
-        resp = requests.delete(assign_url, headers={
-            'X-Auth-Token': self._auth_token,
-            'Content-Type': 'application/json'
-        }, verify=django_settings.VERIFY_REQUESTS)
+        try:
+            applied = (role_id in self._get_user_roles(app_id, user_id)) == assign
+        except Exception:
+            # The assignments could not be listed, make the update anyway
+            applied = False
 
-        resp.raise_for_status()
+        if applied:
+            operation = 'assign_role' if assign else 'remove_role'
+            metrics.registry.inc('ngsi_dataset_skipped_role_updates_total', {'operation': operation})
+            return
+
+        resp = self._set_role(method, app_id, user, role_id)
+
+        if resp.status_code == 404 and cached:
+            # The cached role may have been removed or recreated, retry with the current roles
+            role_cache.invalidate(app_id)
+
+            role_id = self.check_role(app_id, role)
+            resp = self._set_role(method, app_id, user, role_id)
+
+        # The assignment may have been applied since it was cached, which leaves it as requested
+        already_applied = (assign and resp.status_code == 409) or (not assign and resp.status_code == 404)
+
+        if not already_applied:
+            try:
+                resp.raise_for_status()
+            except Exception:
+                assignment_cache.invalidate(app_id, user_id)
+                raise
+
+        assignment_cache.update(app_id, user_id, role_id, assign)
+
+    def grant_permission(self, app_id, user, role):
+        self._update_role(http_client.post, app_id, user, role)
+
+    def revoke_permission(self, app_id, user, role):
+        self._update_role(http_client.delete, app_id, user, role)
+
+    def apply_permissions(self, operations):
+        # Operations are tuples (action, app_id, user, role) where action is grant or revoke,
+        # the result of each operation is returned in the same order
+        methods = {
+            'grant': http_client.post,
+            'revoke': http_client.delete
+        }
+
+        # Roles are retrieved once per application before starting the workers
+        app_errors = {}
+        app_operations = {}
+        for action, app_id, user, role in operations:
+            app_operations[app_id] = app_operations.get(app_id, 0) + 1
+
+            if app_id not in app_errors:
+                try:
+                    self._get_roles(app_id)
+                    app_errors[app_id] = None
+                except Exception as e:
+                    app_errors[app_id] = e
+
+        # The assignments of applications with several updates are listed at once instead of per user
+        for app_id, count in app_operations.items():
+            if count > 1 and app_errors[app_id] is None and not assignment_cache.has_app(app_id):
+                try:
+                    self.get_role_assignments(app_id)
+                except Exception:
+                    pass
+
+        def process(operation):
+            action, app_id, user, role = operation
+
+            try:
+                if app_errors[app_id] is not None:
+                    raise app_errors[app_id]
+
+                self._update_role(methods[action], app_id, user, role)
+            except Exception as e:
+                return {'success': False, 'error': '{}'.format(e)}
+
+            return {'success': True, 'error': None}
+
+        if not len(operations):
+            return []
+
+        pool = ThreadPool(min(IDM_BULK_WORKERS, len(operations)))
+        try:
+            return pool.map(metrics.bind(process), operations)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from functools import wraps
+from urlparse import urlparse
+
+from settings import METRICS_PORT, METRICS_TRACE
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger(__name__ + '.trace')
+
+# Latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def reset(self):
+        # Every process reports its own measures
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, description):
+        self._help[name] = (kind, description)
+
+    def inc(self, name, labels, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts followed by the sum and the count of the observations
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+
+            for position, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[position] += 1
+
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def _format_labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+
+        return '{' + ','.join('{}="{}"'.format(
+            name, '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+    def exposition(self):
+        # Prometheus text exposition format
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((key, list(value)) for key, value in self._histograms.items())
+
+        lines = []
+        for name in sorted(set([key[0] for key in counters] + [key[0] for key in histograms])):
+            if name in self._help:
+                kind, description = self._help[name]
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('{}{} {}'.format(name, self._format_labels(labels), value))
+
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+
+                for bound, count in zip(BUCKETS, histogram):
+                    lines.append('{}_bucket{} {}'.format(name, self._format_labels(labels, [('le', bound)]), count))
+
+                lines.append('{}_bucket{} {}'.format(name, self._format_labels(labels, [('le', '+Inf')]), histogram[-1]))
+                lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), histogram[-2]))
+                lines.append('{}_count{} {}'.format(name, self._format_labels(labels), histogram[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+registry.describe('ngsi_dataset_outbound_requests_total', 'counter', 'Calls made to remote dependencies')
+registry.describe('ngsi_dataset_outbound_duration_seconds', 'histogram', 'Latency of the calls to remote dependencies')
+registry.describe('ngsi_dataset_outbound_retries_total', 'counter', 'Retries made by the HTTP connection pools')
+registry.describe('ngsi_dataset_outbound_sent_bytes_total', 'counter', 'Bytes sent to remote dependencies')
+registry.describe('ngsi_dataset_outbound_received_bytes_total', 'counter', 'Bytes received from remote dependencies')
+registry.describe('ngsi_dataset_hook_duration_seconds', 'histogram', 'Latency of the plugin hooks')
+registry.describe('ngsi_dataset_hook_errors_total', 'counter', 'Plugin hooks failed')
+
+
+# Labels (service, operation, hook) and trace of the current thread
+_context = threading.local()
+
+
+def current_labels():
+    return dict(getattr(_context, 'labels', {}))
+
+
+@contextmanager
+def labels(**kwargs):
+    previous = getattr(_context, 'labels', {})
+    _context.labels = dict(previous, **kwargs)
+    try:
+        yield
+    finally:
+        _context.labels = previous
+
+
+def bind(func):
+    # Propagates the labels and trace of the caller to functions run in other threads
+    bound_labels = current_labels()
+    bound_trace = getattr(_context, 'trace', None)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous_trace = getattr(_context, 'trace', None)
+        _context.trace = bound_trace
+        try:
+            with labels(**bound_labels):
+                return func(*args, **kwargs)
+        finally:
+            _context.trace = previous_trace
+
+    return wrapper
+
+
+def _record(service, operation, status, elapsed, retries=0, sent=0, received=0):
+    context = current_labels()
+    call_labels = {
+        'service': service,
+        'operation': operation,
+        'hook': context.get('hook', '')
+    }
+
+    registry.observe('ngsi_dataset_outbound_duration_seconds', call_labels, elapsed)
+    registry.inc('ngsi_dataset_outbound_requests_total', dict(call_labels, status=status))
+
+    if retries:
+        registry.inc('ngsi_dataset_outbound_retries_total', call_labels, retries)
+    if sent:
+        registry.inc('ngsi_dataset_outbound_sent_bytes_total', call_labels, sent)
+    if received:
+        registry.inc('ngsi_dataset_outbound_received_bytes_total', call_labels, received)
+
+    trace = getattr(_context, 'trace', None)
+    if trace is not None:
+        trace.append({
+            'service': service,
+            'operation': operation,
+            'status': status,
+            'duration_ms': round(elapsed * 1000, 3)
+        })
+
+
+def record_request(method, url, start, response=None, error=None):
+    context = current_labels()
+    service = context.get('service') or urlparse(url).netloc
+    operation = context.get('operation') or method.lower()
+
+    if response is None:
+        _record(service, operation, type(error).__name__, time.time() - start)
+        return
+
+    # Responses are not streamed, so their content is already loaded
+    retries = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+    body = response.request.body if response.request is not None else None
+
+    _record(
+        service, operation, '{}'.format(response.status_code), time.time() - start, retries=len(retries),
+        sent=len(body or b''), received=len(response.content or b''))
+
+
+@contextmanager
+def timed(service, operation):
+    # Instruments calls made without the HTTP pools, e.g. database lookups
+    start = time.time()
+    status = 'ok'
+    try:
+        yield
+    except Exception as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _record(service, operation, status, time.time() - start)
+
+
+def hook(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            previous_trace = getattr(_context, 'trace', None)
+            _context.trace = [] if METRICS_TRACE else None
+
+            try:
+                with labels(hook=name):
+                    return func(*args, **kwargs)
+            except Exception:
+                registry.inc('ngsi_dataset_hook_errors_total', {'hook': name})
+                raise
+            finally:
+                elapsed = time.time() - start
+                registry.observe('ngsi_dataset_hook_duration_seconds', {'hook': name}, elapsed)
+
+                if _context.trace is not None:
+                    trace_logger.info(json.dumps({
+                        'hook': name,
+                        'duration_ms': round(elapsed * 1000, 3),
+                        'spans': _context.trace
+                    }))
+
+                _context.trace = previous_trace
+
+        return wrapper
+
+    return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        payload = registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = {'pid': None}
+
+
+def start_http_server(port=METRICS_PORT):
+    # Metrics are kept per process, with several workers only the first one gets the port
+    if _server['pid'] == os.getpid():
+        return None
+
+    _server['pid'] = os.getpid()
+    try:
+        server = HTTPServer(('', port), _MetricsHandler)
+    except Exception as e:
+        logger.warning('Metrics endpoint not started on port %s: %s', port, e)
+        return None
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
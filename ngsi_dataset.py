@@ -19,19 +19,37 @@
 
 from __future__ import unicode_literals
 
-import requests
-from urlparse import urlparse, urljoin
+import calendar
+import logging
+import time
+from datetime import datetime
+from urlparse import urlparse
 
 from django.conf import settings as django_settings
 
+from wstore.asset_manager.models import Resource
 from wstore.asset_manager.resource_plugins.plugin import Plugin
 from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 from wstore.models import User
+from wstore.ordering.models import Offering, Order
 
-from keyrock_client import KeyrockClient
-from umbrella_client import UmbrellaClient
+import metrics
+from catalog_client import CatalogClient, spec_cache
+from ckan_client import CKANClient
+from client_registry import clients
+from concurrency import run_concurrently
+from job_queue import FAILED, RetryLater, ckan_queue
+from ngsi_query import parse_query
+from orion_client import OrionClient
+from usage_ledger import usage_ledger
+from usage_store import UsageWindowFull, usage_store
 
-from settings import UNITS
+from settings import UNITS, ACCOUNTING_MAX_DAYS, USAGE_STORE_BUCKETS, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Product spec characteristics managed by the plugin, in the order they are included
+NGSI_CHARACTERISTICS = ('Entities', 'Attributes', 'Expression', 'Entity count', 'Estimated size')
 
 
 class NGSIDataset(Plugin):
@@ -40,48 +58,67 @@ class NGSIDataset(Plugin):
         super(NGSIDataset, self).__init__(plugin_model)
         self._units = UNITS
 
-    def _get_access_token(self):
-        user = User.objects.get(name=self._user_id)
-        return user.userprofile.access_token
+        if METRICS_PORT:
+            metrics.start_http_server(METRICS_PORT)
 
-    def create_dataset(self, product, data_url, data_info):
-        name = product['name'].lower().replace(' ', '-')
-        description = ''
-        if 'description' in product and product['description'] is not None:
-            description = product['description']
+        # The clients are shared by the plugin instances of the process
+        clients.initialize()
 
-        service = ''
-        if 'service' in data_info['service'] and data_info['service'] is not None:
-            service = data_info['service']
+        # CKAN operations are run by the background job queue, whose workers also resume the jobs
+        # left by a previous process
+        ckan_queue.register('create_dataset', self._create_dataset_job)
+        ckan_queue.register('update_acquire_url', self._update_acquire_url_job)
+        ckan_queue.register('activate_dataset', self._activate_dataset_job)
+        ckan_queue.register('update_product', self._update_product_job)
+        ckan_queue.start()
 
-        service_path = ''
-        if 'service_path' in data_info['service_path'] and data_info['service_path'] is not None:
-            service_path = data_info['service_path']
+    def _get_access_token(self, user_id=None):
+        with metrics.timed('django', 'get_access_token'):
+            user = User.objects.get(name=user_id or self._user_id)
+            return user.userprofile.access_token
 
-        # Build URL query using data info
-        url = data_url
-        if not data_url.endswith('/'):
-            data_url = data_url + '/'
+    def _has_dataset(self, asset):
+        return 'ckan_url' in asset.meta_info and asset.meta_info['ckan_url'] is not None and \
+            asset.meta_info['ckan_url'] != ''
 
-        data_url = data_url + 'v2/entities'
-        query = ''
+    def _get_dataset_asset(self, asset_id):
+        asset = Resource.objects.get(pk=asset_id)
 
-        if 'entities' in data_info and data_info['entities'] is not None:
-            query = '?type=' + data_info['entities']
+        if 'dataset_id' not in asset.meta_info:
+            # The job waits for the dataset creation one, without using its attempts, unless it has failed
+            creation = ckan_queue.get_job('{}:create_dataset'.format(asset_id))
+            if creation is None or creation['status'] == FAILED:
+                raise PluginError('The CKAN dataset has not been created')
 
-        if 'attrs' in data_info and data_info['attrs'] is not None:
-            if query == '':
-                query = query + '?attrs=' + data_info['attrs']
-            else:
-                query = query + '&attrs=' + data_info['attrs']
+            raise RetryLater('The CKAN dataset has not been created yet')
 
-        if 'expression' in data_info and data_info['expression'] is not None:
-            if query == '':
-                query = query + '?' + data_info['expression']
-            else:
-                query = query + '&' + data_info['expression']
+        return asset
+
+    def create_dataset(self, product, data_url, data_info, user_id=None):
+        name = product['name'].lower().replace(' ', '-')
+        description = ''
+        if 'description' in product and product['description'] is not None:
+            description = product['description']
+
+        # Build a paginated URL of the validated query
+        query = parse_query(data_info)
+        data_url = query.get_url(data_url)
+
+        resource = {
+            "auth_type": "oauth2",
+            "entity": [],
+            "format": "fiware-ngsi",
+            "name": "NGSI query",
+            "url": data_url,
+            "tenant": query.service or '',
+            "service_path": query.service_path or ''
+        }
 
-        data_url = data_url + query
+        if data_info.get('profile') is not None:
+            # Let consumers know the cost of the query before acquiring it
+            resource['size'] = data_info['profile']['estimated_size']
+            resource['entity_count'] = data_info['profile']['entity_count']
+            resource['attributes'] = ','.join(data_info['profile']['attributes'])
 
         dataset_info = {
 	        "private": True,
@@ -91,134 +128,270 @@ class NGSIDataset(Plugin):
 	        "notes": description,
 	        "isopen": True,
             "searchable": "True",
-            "resources": [{
-                "auth_type": "oauth2",
-                "entity": [],
-                "format": "fiware-ngsi",
-                "name": "NGSI query",
-                "url": data_url,
-                "tenant": data_info['service'],
-                "service_path": data_info['service_path']
-            }]
+            "resources": [resource]
         }
 
-        ckan_url = data_info['ckan_url']
-        if not ckan_url.endswith('/'):
-            ckan_url = ckan_url + '/'
+        client = self._get_ckan_client(data_info['ckan_url'], user_id)
+        try:
+            return client.create_dataset(dataset_info)
+        except PluginError:
+            # The dataset may have been created by a previous execution whose answer was lost,
+            # in that case its name is already in use by a dataset of the same query
+            dataset = client.get_dataset(name)
 
-        ckan_url = ckan_url + 'api/3/action/package_create'
+            if dataset is None or data_url not in [resource.get('url') for resource in dataset.get('resources', [])]:
+                raise
 
-        resp = requests.post(ckan_url, json=dataset_info, headers={
-            'Authorization': 'Bearer ' + self._get_access_token()
-        })
-
-        if resp.status_code != 200:
-            raise PluginError('It had not being possible to create CKAN dataset')
+            return dataset
 
-        return resp.json()['result']
+    def profile_dataset(self, data_url, data_info, user_id=None):
+        # Computes the entity count, attributes and estimated size of the NGSI query
+        query = parse_query(data_info)
+        client = OrionClient(data_url, headers=query.get_headers(), token_loader=lambda: self._get_access_token(user_id))
 
-    def update_dataset_acquire_url(self, url, dataset_id, product_id):
-        # Get updated dataset info
-        ckan_url = url
-        if not ckan_url.endswith('/'):
-            ckan_url = ckan_url + '/'
+        profile = client.profile(dict(query.get_params()))
 
-        show_url = ckan_url + 'api/3/action/package_show?id={}'.format(dataset_id)
-        resp = requests.post(show_url, headers={
-            'Authorization': 'Bearer ' + self._get_access_token()
-        })
+        # The values representations do not include the attribute names, they are the requested ones
+        if not len(profile['attributes']):
+            profile['attributes'] = list(query.attrs)
 
-        if resp.status_code != 200:
-            raise PluginError('It has not been posible to update acquire URL')
+        return profile
 
-        dataset_info = resp.json()['result']
+    def _get_ckan_client(self, ckan_url, user_id=None):
+        return CKANClient(ckan_url, token_loader=lambda: self._get_access_token(user_id))
 
-        # Generate Acquire URL
+    def _get_acquire_url(self, product_id):
         parsed_site = urlparse(django_settings.SITE)
-        acquire_url = '{}://{}/#/offering?productSpecId={}'.format(parsed_site.schema, parsed_site.netloc, product_id)
+        return '{}://{}/#/offering?productSpecId={}'.format(parsed_site.scheme, parsed_site.netloc, product_id)
 
-        dataset_info['acquire_url'] = acquire_url
-
-        update_url = ckan_url + 'api/3/action/package_update?id={}'.format(dataset_id)
-        resp = requests.post(show_url, json=dataset_info, headers={
-            'Authorization': 'Bearer ' + self._get_access_token()
+    def update_dataset_acquire_url(self, url, dataset_id, product_id, user_id=None):
+        # Only the acquire URL is sent to CKAN
+        client = self._get_ckan_client(url, user_id)
+        client.patch_dataset(dataset_id, {
+            'acquire_url': self._get_acquire_url(product_id)
         })
 
-        if resp.status_code != 200:
-            raise PluginError('It has not been posible to update acquire URL')
+    def update_acquire_urls(self, datasets, user_id=None):
+        # Updates the acquire URL of several (ckan_url, dataset_id, product_id) datasets, e.g. after
+        # a change of the SITE setting, making a single pass per data portal. Returns the result
+        # of each update in the same order
+        portals = {}
+        for position, (ckan_url, dataset_id, product_id) in enumerate(datasets):
+            portals.setdefault(ckan_url.rstrip('/'), []).append((position, dataset_id, product_id))
+
+        results = [None] * len(datasets)
+        for ckan_url, portal_datasets in portals.items():
+            client = self._get_ckan_client(ckan_url, user_id)
+            portal_results = client.patch_datasets([
+                (dataset_id, {'acquire_url': self._get_acquire_url(product_id)})
+                for position, dataset_id, product_id in portal_datasets
+            ])
 
+            for (position, dataset_id, product_id), result in zip(portal_datasets, portal_results):
+                results[position] = result
+
+        return results
+
+    @metrics.hook('spec_validation')
     def on_post_product_spec_validation(self, provider, asset):
         self._user_id = provider.name
 
+        # Invalid NGSI queries are rejected before contacting any service
+        parse_query(asset.meta_info)
+
         parsed_url = urlparse(asset.get_url())
 
-        # Validate that the provided URL is a valid API in API Umbrella
-        client = UmbrellaClient()
-        app_id = client.validate_service(parsed_url.path)
+        # Validate that the provided URL is a valid API in API Umbrella,
+        # meanwhile the IdM client logs in as it does not depend on the API
+        client = clients.get_umbrella()
+        app_id, keyrock_client = run_concurrently(
+            lambda: client.validate_service(parsed_url.path),
+            clients.get_keyrock)
 
         # Check that the provider is authorized to create an offering in the current App
-        keyrock_client = KeyrockClient()
-        keyrock_client.check_ownership(app_id, provider.name)
-
-        # Check that the provided role is registered in the specified App
-        keyrock_client.check_role(app_id, asset.meta_info['role'])
+        # and that the provided role is registered in the specified App
+        run_concurrently(
+            lambda: keyrock_client.check_ownership(app_id, provider.name),
+            lambda: keyrock_client.check_role(app_id, asset.meta_info['role']))
 
         asset.meta_info['app_id'] = app_id
         asset.save()
 
-    def update_product(self, product_spec, data_info):
-        product_url = django_settings.CATALOG
-        if not product_url.endswith('/'):
-            product_url = product_url + '/'
-        
-        product_url = product_url + 'api/catalogManagement/v2/productSpecification/{}'.format(product_spec['id'])
-        charact = product_spec['productSpecCharacteristic']
+    def _get_characteristic(self, name, description, value, value_type="string", unit=""):
+        return {
+            'configurable': False,
+            'description': description,
+            'name': name,
+            'productSpecCharacteristicValue': [{
+                'value': value, 'unitOfMeasure': unit, 'valueFrom': "", 'valueTo': "", 'default': True}],
+            'valueType': value_type
+        }
+
+    def _get_characteristics(self, data_info):
+        # NGSI specific characteristics of the product, by name
+        charact = {}
 
         if 'entities' in data_info and data_info['entities'] is not None:
-            charact.append({
-                'configurable': False,
-                'description': 'NGSI Entities provided',
-                'name': 'Entities',
-                'productSpecCharacteristicValue': [{
-                    'value': data_info['entities'], 'unitOfMeasure': "", 'valueFrom': "", 'valueTo': "", 'default': True}],
-                'valueType': "string"
-            })
+            charact['Entities'] = self._get_characteristic('Entities', 'NGSI Entities provided', data_info['entities'])
 
         if 'attrs' in data_info and data_info['attrs'] is not None:
-            charact.append({
-                'configurable': False,
-                'description': 'NGSI Atributtes provided',
-                'name': 'Attributes',
-                'productSpecCharacteristicValue': [{
-                    'value': data_info['attrs'], 'unitOfMeasure': "", 'valueFrom': "", 'valueTo': "", 'default': True}],
-                'valueType': "string",
-            })
+            charact['Attributes'] = self._get_characteristic(
+                'Attributes', 'NGSI Atributtes provided', data_info['attrs'])
 
         if 'expression' in data_info and data_info['expression'] is not None:
-            charact.append({
-                'configurable': False,
-                'description': 'NGSI Expression',
-                'name': 'Expression',
-                'productSpecCharacteristicValue': [{
-                    'value': data_info['expression'], 'unitOfMeasure': "", 'valueFrom': "", 'valueTo': "", 'default': True}],
-                'valueType': "string"
-            })
+            charact['Expression'] = self._get_characteristic('Expression', 'NGSI Expression', data_info['expression'])
+
+        if data_info.get('profile') is not None:
+            charact['Entity count'] = self._get_characteristic(
+                'Entity count', 'Number of NGSI entities returned by the query',
+                '{}'.format(data_info['profile']['entity_count']), value_type="number")
+
+            charact['Estimated size'] = self._get_characteristic(
+                'Estimated size', 'Estimated size of the query result',
+                '{}'.format(data_info['profile']['estimated_size']), value_type="number", unit="bytes")
+
+        return charact
+
+    def _matches(self, current, desired):
+        # The catalog may include extra fields, only the ones of the desired value are compared
+        if isinstance(desired, dict):
+            return isinstance(current, dict) and all(
+                self._matches(current.get(key), value) for key, value in desired.items())
+
+        if isinstance(desired, list):
+            return isinstance(current, list) and len(current) == len(desired) and all(
+                self._matches(cur, des) for cur, des in zip(current, desired))
+
+        return current == desired
+
+    def _merge_characteristics(self, current, data_info):
+        # Returns the characteristics with the NGSI ones updated, or None if there is nothing to change
+        desired = self._get_characteristics(data_info)
+
+        merged = []
+        changed = False
+        for charact in current:
+            if charact.get('name') in NGSI_CHARACTERISTICS:
+                new_charact = desired.pop(charact['name'], None)
+
+                if new_charact is None:
+                    # Removed or repeated characteristic
+                    changed = True
+                elif not self._matches(charact, new_charact):
+                    changed = True
+                    merged.append(new_charact)
+                else:
+                    merged.append(charact)
+            else:
+                merged.append(charact)
 
-        requests.patch(url, json={
-            'productSpecCharacteristic': charact
-        })
+        if len(desired):
+            changed = True
+            merged.extend(desired[name] for name in NGSI_CHARACTERISTICS if name in desired)
+
+        return merged if changed else None
 
+    def update_product(self, product_spec, data_info):
+        # Sends the NGSI characteristics to the catalog only if they have changed. Returns whether
+        # the product spec has been updated
+        return self.update_products([(product_spec['id'], data_info)])[0]['updated']
+
+    def update_products(self, updates):
+        # Updates the characteristics of several (spec_id, data_info) product specs in one pass, the
+        # latest pending update of each spec is the one applied. Returns the result of each update
+        latest = {}
+        for position, (spec_id, data_info) in enumerate(updates):
+            latest[spec_id] = (position, data_info)
+
+        client = CatalogClient()
+        results = [None] * len(updates)
+
+        for spec_id, (position, data_info) in latest.items():
+            result = {'success': True, 'updated': False, 'error': None}
+
+            try:
+                # Specs known to be up to date are not even retrieved
+                cached = spec_cache.get(spec_id)
+
+                if cached is None or self._merge_characteristics(cached, data_info) is not None:
+                    current = client.get_spec(spec_id).get('productSpecCharacteristic') or []
+                    merged = self._merge_characteristics(current, data_info)
+
+                    if merged is not None:
+                        client.patch_spec(spec_id, {
+                            'productSpecCharacteristic': merged
+                        })
+                        result['updated'] = True
+            except Exception as e:
+                result = {'success': False, 'updated': False, 'error': '{}'.format(e)}
+
+            results[position] = result
+
+        # Coalesced updates share the result of the applied one
+        for position, (spec_id, data_info) in enumerate(updates):
+            if results[position] is None:
+                results[position] = dict(results[latest[spec_id][0]])
+
+        return results
+
+    @metrics.hook('spec_attachment')
     def on_post_product_spec_attachment(self, asset, asset_t, product_spec):
         self._user_id = asset.provider.name
         # Include NGSI specific info as characteristics of the product
-        # If CKAN URL has been included register a new dataset
-        if 'ckan_url' in asset.meta_info and asset.meta_info['ckan_url'] is not None and asset.meta_info['ckan_url'] != '':
-            dataset = self.create_dataset(product_spec, asset.get_url(), asset.meta_info)
-            asset.meta_info['dataset_id'] = dataset['id']
-            asset.save()
+        # If CKAN URL has been included register a new dataset, the characteristics are updated
+        # once its query has been profiled so the spec is only updated once
+        if self._has_dataset(asset):
+            ckan_queue.enqueue('{}:create_dataset'.format(asset.pk), 'create_dataset', {
+                'asset_id': '{}'.format(asset.pk),
+                'product': {
+                    'id': product_spec.get('id'),
+                    'name': product_spec['name'],
+                    'description': product_spec.get('description')
+                },
+                'user_id': self._user_id
+            })
+
+        elif product_spec.get('id') is not None:
+            # The characteristics are updated in background
+            ckan_queue.enqueue('{}:update_product'.format(asset.pk), 'update_product', {
+                'asset_id': '{}'.format(asset.pk),
+                'spec_id': product_spec['id']
+            })
+
+    def _update_product_job(self, payload):
+        asset = Resource.objects.get(pk=payload['asset_id'])
+        result = self.update_products([(payload['spec_id'], asset.meta_info)])[0]
+
+        if not result['success']:
+            raise PluginError(result['error'])
+
+    def _create_dataset_job(self, payload):
+        asset = Resource.objects.get(pk=payload['asset_id'])
+
+        # The dataset may have been created by a previous execution of the job
+        if 'dataset_id' in asset.meta_info:
+            return
+
+        if asset.meta_info.get('profile') is None:
+            try:
+                asset.meta_info['profile'] = self.profile_dataset(asset.get_url(), asset.meta_info, user_id=payload['user_id'])
+                asset.save()
+            except Exception as e:
+                # The dataset is published anyway, only without the query figures
+                logger.warning('The NGSI query of asset %s could not be profiled: %s', payload['asset_id'], e)
+
+        # Include the NGSI characteristics, and the figures of the query, in the product spec
+        if payload['product'].get('id') is not None:
+            ckan_queue.enqueue('{}:update_product'.format(asset.pk), 'update_product', {
+                'asset_id': payload['asset_id'],
+                'spec_id': payload['product']['id']
+            })
 
-        #self.update_product(product_spec, asset.meta_info)
+        dataset = self.create_dataset(payload['product'], asset.get_url(), asset.meta_info, user_id=payload['user_id'])
+        asset.meta_info['dataset_id'] = dataset['id']
+        asset.save()
 
+    @metrics.hook('offering_validation')
     def on_post_product_offering_validation(self, asset, product_offering):
         self._user_id = asset.provider.name
 
@@ -236,54 +409,222 @@ class NGSIDataset(Plugin):
                                           price_model['unit'] + '. Supported units are: ' + ','.join(supported_units))
 
         # If CKAN dataset has been registered, attach acquisition URL
-        if 'dataset_id' in asset.meta_info:
-            self.update_dataset_acquire_url(data_info['ckan_url'], asset.meta_info['dataset_id'], asset.product_id)
+        if self._has_dataset(asset):
+            ckan_queue.enqueue('{}:update_acquire_url'.format(asset.pk), 'update_acquire_url', {
+                'asset_id': '{}'.format(asset.pk),
+                'user_id': self._user_id
+            })
 
-    def activate_ckan_dataset(self, ckan_url, dataset_id, customer):
-        notification_url = urljoin(ckan_url, '/api/action/package_acquired')
-        dataset_url = urljoin(ckan_url, '/dataset/{}'.format(dataset_id))
-
-        # Build notification data
-        data = {
-            'customer_name': customer,
-            'resources': [{
-                'url': dataset_url
-            }]
-        }
+    def _update_acquire_url_job(self, payload):
+        asset = self._get_dataset_asset(payload['asset_id'])
+        self.update_dataset_acquire_url(
+            asset.meta_info['ckan_url'], asset.meta_info['dataset_id'], asset.product_id, user_id=payload['user_id'])
 
-        # Notify the dataset acquisition to CKAN
-        headers = {'Content-type': 'application/json'}
-        response = requests.post(
-            notification_url,
-            json=data,
-            headers=headers,
-            verify=django_settings.VERIFY_REQUESTS,
-            cert=(django_settings.NOTIF_CERT_FILE, django_settings.NOTIF_CERT_KEY_FILE)
-        )
-        response.raise_for_status()
+    def activate_ckan_dataset(self, ckan_url, dataset_id, customer):
+        client = CKANClient(ckan_url)
+        client.notify_acquisition(dataset_id, customer)
 
+    @metrics.hook('acquisition')
     def on_product_acquisition(self, asset, contract, order):
         self._user_id = order.owner_organization.name
 
         # Activate API resources
-        client = KeyrockClient()
+        client = clients.get_keyrock()
         client.grant_permission(asset.meta_info['app_id'], order.customer, asset.meta_info['role'])
 
-        if 'dataset_id' in asset.meta_info:
+        self._activate_dataset(asset, order)
+
+    def _activate_dataset(self, asset, order):
+        if self._has_dataset(asset):
             # User need to be included in the authorized users list of the dataset
-            self.activate_ckan_dataset(
-                asset.meta_info['ckan_url'], asset.meta_info['asset_id'], order.owner_organization.name)
+            ckan_queue.enqueue('{}:activate_dataset:{}'.format(asset.pk, order.order_id), 'activate_dataset', {
+                'asset_id': '{}'.format(asset.pk),
+                'customer': order.owner_organization.name
+            })
+
+    def _activate_dataset_job(self, payload):
+        asset = self._get_dataset_asset(payload['asset_id'])
+        self.activate_ckan_dataset(asset.meta_info['ckan_url'], asset.meta_info['dataset_id'], payload['customer'])
 
+    @metrics.hook('suspension')
     def on_product_suspension(self, asset, contract, order):
         self._user_id = order.owner_organization.name
 
         # Suspend API Resources
-        client = KeyrockClient()
+        client = clients.get_keyrock()
         client.revoke_permission(asset.meta_info['app_id'], order.customer, asset.meta_info['role'])
 
+    def _bulk_permissions(self, action, items):
+        operations = [
+            (action, asset.meta_info['app_id'], order.customer, asset.meta_info['role'])
+            for asset, contract, order in items
+        ]
+
+        client = clients.get_keyrock()
+        return client.apply_permissions(operations)
+
+    @metrics.hook('bulk_acquisition')
+    def bulk_product_acquisition(self, acquisitions):
+        # Acquisitions are (asset, contract, order) tuples, returns the result of each one
+        results = self._bulk_permissions('grant', acquisitions)
+
+        for (asset, contract, order), result in zip(acquisitions, results):
+            if not result['success']:
+                continue
+
+            try:
+                self._activate_dataset(asset, order)
+            except Exception as e:
+                result['success'] = False
+                result['error'] = '{}'.format(e)
+
+        return results
+
+    @metrics.hook('bulk_suspension')
+    def bulk_product_suspension(self, suspensions):
+        # Suspensions are (asset, contract, order) tuples, returns the result of each one
+        return self._bulk_permissions('revoke', suspensions)
+
+    def _get_asset_customers(self):
+        # Returns the customers with an active contract for any offering, or bundle, of each asset. The
+        # orders and offerings are read once for all the reconciled assets
+        customers = {}
+        for order in Order.objects.all():
+            for contract in order.contracts:
+                if contract.terminated or getattr(contract, 'suspended', False):
+                    continue
+
+                customers.setdefault('{}'.format(contract.offering.pk), set()).add(order.customer.username)
+
+        offerings = list(Offering.objects.all())
+
+        bundles = {}
+        for bundle in offerings:
+            for offering in bundle.bundled_offerings or []:
+                bundles.setdefault('{}'.format(offering), []).append('{}'.format(bundle.pk))
+
+        asset_customers = {}
+        for offering in offerings:
+            if offering.asset_id is None:
+                continue
+
+            users = asset_customers.setdefault('{}'.format(offering.asset_id), set())
+            for offering_id in ['{}'.format(offering.pk)] + bundles.get('{}'.format(offering.pk), []):
+                users.update(customers.get(offering_id, []))
+
+        return asset_customers
+
+    @metrics.hook('reconciliation')
+    def reconcile_permissions(self, app_id=None, dry_run=False):
+        # Makes the IDM role assignments match the active contracts of the datasets, the
+        # assets sharing an application and role are reconciled together
+        groups = {}
+        for asset in Resource.objects.filter(resource_type=self._model.name):
+            if 'app_id' not in asset.meta_info or (app_id is not None and asset.meta_info['app_id'] != app_id):
+                continue
+
+            key = (asset.meta_info['app_id'], asset.meta_info['role'].lower())
+            groups.setdefault(key, []).append(asset)
+
+        client = clients.get_keyrock()
+        asset_customers = self._get_asset_customers() if groups else {}
+
+        reports = []
+        for (group_app, role), assets in sorted(groups.items()):
+            users = set()
+            for asset in assets:
+                users.update(asset_customers.get('{}'.format(asset.pk), []))
+
+            try:
+                reports.append(client.reconcile_role(group_app, role, users, dry_run=dry_run))
+            except Exception as e:
+                reports.append({'app_id': group_app, 'role': role, 'dry_run': dry_run, 'error': '{}'.format(e)})
+
+        return reports
+
     def get_usage_specs(self):
         return self._units
 
-    def get_pending_accounting(self, asset, contract, order):
-        return []
+    def _get_accounting_start(self, customer, app, contract):
+        since = usage_store.get_mark(customer, app)
+        if since is not None:
+            return since
 
+        # Usage older than the accounting period or than the store window is not charged
+        oldest = int((time.time() - ACCOUNTING_MAX_DAYS * 24 * 3600) * 1000)
+        oldest = max(oldest, (int(time.time() // 3600) - USAGE_STORE_BUCKETS + 1) * 3600 * 1000)
+
+        if contract.last_usage is not None:
+            return max(oldest, calendar.timegm(contract.last_usage.timetuple()) * 1000)
+
+        return oldest
+
+    @metrics.hook('pending_accounting')
+    def get_pending_accounting(self, asset, contract, order):
+        accounting = []
+
+        if 'pay_per_use' not in contract.pricing_model:
+            return accounting
+
+        units = set([price['unit'].lower() for price in contract.pricing_model['pay_per_use']])
+        if 'api call' not in units:
+            return accounting
+
+        # Assets may share the IdM application, so usage is kept per asset
+        customer = order.customer.username
+        app = '{}:{}'.format(asset.meta_info['app_id'], asset.pk)
+
+        # The billing updates the last usage of the contract once it has received the records, if it has
+        # not changed the records sent by the previous pull are sent again as they were
+        contract_key = '{}:{}:{}'.format(order.order_id, contract.item_id, asset.pk)
+        observed = None
+        if contract.last_usage is not None:
+            observed = calendar.timegm(contract.last_usage.timetuple()) * 1000
+
+        pending = usage_ledger.get_pending(contract_key)
+        if pending is not None:
+            if pending['observed'] == observed:
+                # The usage may have been saved without releasing the billed hours
+                usage_store.compact(customer, app, pending['end_hour'])
+                return pending['records']
+
+            usage_ledger.mark_billed(contract_key, pending['batch'])
+
+        # Only the calls made since the last pull are read, the store discards
+        # the ones already counted if the pull is repeated
+        since = self._get_accounting_start(customer, app, contract)
+        client = clients.get_umbrella()
+
+        # Only complete hours are billed, calls of the current one are reported in the next pull
+        current_hour = int(time.time() // 3600)
+
+        try:
+            for hour, calls, last_request in client.get_accounting(
+                    order.customer.email, asset.get_url(), since, 'api call'):
+                usage_store.add(customer, app, hour, calls, last_request)
+        except UsageWindowFull:
+            # The hours in the store are billed now, the following pulls go on from the mark
+            current_hour = min(current_hour, usage_store.get_window_end(customer, app))
+
+        first_hour = usage_store.get_first_hour(customer, app)
+
+        if first_hour is None:
+            return accounting
+
+        records = []
+        for day_start in range(first_hour - first_hour % 24, current_hour, 24):
+            day_end = min(day_start + 24, current_hour)
+            calls = usage_store.sum(customer, app, max(day_start, first_hour), day_end)
+
+            if calls > 0:
+                records.append((max(day_start, first_hour), day_end, {
+                    'unit': 'api call',
+                    'value': calls,
+                    'date': datetime.utcfromtimestamp(day_start * 3600).isoformat() + 'Z'
+                }))
+
+        # Records are saved before releasing the hours, so they can be replayed if the billing fails
+        accounting = usage_ledger.append_batch(contract_key, observed, current_hour, records)
+
+        usage_store.compact(customer, app, current_hour)
+        return accounting
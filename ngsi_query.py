@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import re
+from urllib import quote, unquote
+
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
+
+from settings import NGSI_QUERY_PAGE_SIZE, NGSI_QUERY_KEY_VALUES
+
+# Maximum number of entities returned by Orion in a single page
+MAX_LIMIT = 1000
+
+# Entity types and attribute names cannot include spaces or the characters forbidden by NGSI v2
+NAME_RE = re.compile(r'^[^\s<>"\'=;()&?/#,]{1,256}$')
+SERVICE_RE = re.compile(r'^[A-Za-z0-9_]{1,50}$')
+SERVICE_PATH_RE = re.compile(r'^/#?$|^(/[A-Za-z0-9_]{1,50}){1,10}(/#)?$')
+COORDS_RE = re.compile(r'^-?\d+(\.\d+)?,-?\d+(\.\d+)?(;-?\d+(\.\d+)?,-?\d+(\.\d+)?)*$')
+GEOREL_RE = re.compile(r'^(near;(maxDistance|minDistance):\d+(\.\d+)?|coveredBy|intersects|equals|disjoint)$')
+
+GEOMETRIES = ('point', 'line', 'polygon', 'box')
+REPRESENTATIONS = ('keyValues', 'values', 'unique')
+
+# Parameters that can be provided in the expression, in the order of the canonical URLs
+FILTER_PARAMS = ('id', 'idPattern', 'q', 'mq', 'georel', 'geometry', 'coords')
+EXPRESSION_PARAMS = FILTER_PARAMS + ('orderBy', 'options', 'limit', 'offset')
+
+
+def _split_list(value, field):
+    items = []
+    for item in value.split(','):
+        item = item.strip()
+
+        if not NAME_RE.match(item):
+            raise PluginError('Invalid {}: {}'.format(field, item or value))
+
+        # Repeated items do not change the query
+        if item not in items:
+            items.append(item)
+
+    return items
+
+
+def _parse_int(value, field, minimum, maximum):
+    try:
+        number = int(value)
+    except ValueError:
+        raise PluginError('The {} of the NGSI query must be a number'.format(field))
+
+    if number < minimum or number > maximum:
+        raise PluginError('The {} of the NGSI query must be between {} and {}'.format(field, minimum, maximum))
+
+    return number
+
+
+# Validated NGSI v2 query of the entities published by a dataset
+class NGSIQuery(object):
+
+    def __init__(self, types, attrs=None, filters=None, options=None, limit=NGSI_QUERY_PAGE_SIZE, offset=0,
+                 service=None, service_path=None):
+
+        self.types = types
+        self.attrs = attrs or []
+        self.filters = filters or {}
+        self.options = options or []
+        self.limit = limit
+        self.offset = offset
+        self.service = service
+        self.service_path = service_path
+
+    def get_params(self, offset=None, limit=None):
+        # Query parameters in canonical order, the page can be overridden to iterate the result
+        params = [('type', ','.join(self.types))]
+
+        for param in FILTER_PARAMS:
+            if param in self.filters:
+                params.append((param, self.filters[param]))
+
+        if len(self.attrs):
+            params.append(('attrs', ','.join(self.attrs)))
+
+        if 'orderBy' in self.filters:
+            params.append(('orderBy', self.filters['orderBy']))
+
+        if len(self.options):
+            params.append(('options', ','.join(self.options)))
+
+        params.append(('limit', '{}'.format(self.limit if limit is None else limit)))
+        params.append(('offset', '{}'.format(self.offset if offset is None else offset)))
+        return params
+
+    def get_url(self, base_url, offset=None, limit=None):
+        url = (base_url if base_url.endswith('/') else base_url + '/') + 'v2/entities'
+
+        # Separators of lists, ranges and coordinates are kept readable
+        query = '&'.join(
+            '{}={}'.format(param, quote(value.encode('utf-8'), safe=b",;:/'"))
+            for param, value in self.get_params(offset, limit))
+
+        return url + '?' + query
+
+    def get_headers(self):
+        headers = {}
+
+        if self.service:
+            headers['Fiware-Service'] = self.service
+
+        if self.service_path:
+            headers['Fiware-ServicePath'] = self.service_path
+
+        return headers
+
+
+def parse_query(data_info):
+    # Builds the query from the fields of the asset form, raising PluginError if it is not valid
+    if not data_info.get('entities'):
+        raise PluginError('The NGSI entity types are required')
+
+    types = _split_list(data_info['entities'], 'entity type')
+
+    attrs = []
+    if data_info.get('attrs'):
+        attrs = _split_list(data_info['attrs'], 'attribute')
+
+    filters = {}
+    for part in (data_info.get('expression') or '').split('&'):
+        # Only & separates parameters, ; separates the conditions of q and mq
+        if not part.strip():
+            continue
+
+        param, _, value = part.partition('=')
+        param = param.strip()
+        value = unquote(value.encode('utf-8')).decode('utf-8')
+
+        if param not in EXPRESSION_PARAMS:
+            raise PluginError('The parameter {} is not supported in the NGSI expression'.format(param))
+
+        if param in filters:
+            raise PluginError('The parameter {} is repeated in the NGSI expression'.format(param))
+
+        if not value.strip():
+            raise PluginError('The parameter {} of the NGSI expression is empty'.format(param))
+
+        filters[param] = value.strip()
+
+    geo_params = [param for param in ('georel', 'geometry', 'coords') if param in filters]
+    if len(geo_params) and len(geo_params) != 3:
+        raise PluginError('Geographical queries require georel, geometry and coords')
+
+    if 'georel' in filters:
+        if not GEOREL_RE.match(filters['georel']):
+            raise PluginError('Invalid georel: {}'.format(filters['georel']))
+
+        if filters['geometry'] not in GEOMETRIES:
+            raise PluginError('Invalid geometry: {}'.format(filters['geometry']))
+
+        if not COORDS_RE.match(filters['coords']):
+            raise PluginError('Invalid coords: {}'.format(filters['coords']))
+
+    limit = _parse_int(filters.pop('limit', NGSI_QUERY_PAGE_SIZE), 'limit', 1, MAX_LIMIT)
+    offset = _parse_int(filters.pop('offset', 0), 'offset', 0, 2 ** 31)
+
+    options = []
+    if 'options' in filters:
+        options = _split_list(filters.pop('options'), 'option')
+
+        for option in options:
+            if option not in REPRESENTATIONS:
+                raise PluginError('The NGSI option {} is not supported'.format(option))
+
+        if len(options) > 1:
+            raise PluginError('Only one representation can be provided in the NGSI options')
+
+    elif NGSI_QUERY_KEY_VALUES:
+        # The simplified representation makes smaller payloads
+        options = ['keyValues']
+
+    service = data_info.get('service') or None
+    if service is not None and not SERVICE_RE.match(service):
+        raise PluginError('Invalid FIWARE Service: {}'.format(service))
+
+    service_path = data_info.get('service_path') or None
+    if service_path is not None:
+        # Queries can include up to 10 comma separated paths
+        paths = [path.strip() for path in service_path.split(',')]
+
+        if len(paths) > 10 or not all(SERVICE_PATH_RE.match(path) for path in paths):
+            raise PluginError('Invalid FIWARE Service Path: {}'.format(service_path))
+
+        service_path = ','.join(paths)
+
+    return NGSIQuery(
+        types, attrs=attrs, filters=filters, options=options, limit=limit, offset=offset,
+        service=service.lower() if service else None, service_path=service_path)
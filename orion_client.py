@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import requests
+
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
+
+import http_client
+import metrics
+from settings import NGSI_PROFILE_SAMPLE_SIZE, NGSI_PROFILE_PAGE_SIZE
+
+
+def _add_option(options, option):
+    options = [opt for opt in (options or '').split(',') if opt]
+    if option not in options:
+        options.append(option)
+
+    return ','.join(options)
+
+
+class OrionClient(object):
+
+    def __init__(self, url, headers=None, token_loader=None):
+        self._url = (url if url.endswith('/') else url + '/') + 'v2/entities'
+
+        # FIWARE Service and Service Path headers of the query
+        self._headers = dict(headers or {})
+
+        # The access token is loaded once per client, as the CKAN one
+        self._token_loader = token_loader
+        self._token = None
+
+    def _get(self, params, operation):
+        headers = dict(self._headers)
+
+        if self._token_loader is not None:
+            if self._token is None:
+                self._token = self._token_loader()
+
+            headers['Authorization'] = 'Bearer ' + self._token
+
+        with metrics.labels(service='orion', operation=operation):
+            try:
+                resp = http_client.get(self._url, params=params, headers=headers)
+            except (requests.ConnectionError, requests.Timeout):
+                raise PluginError('The NGSI server is not responding')
+
+        if resp.status_code != 200:
+            raise PluginError('The NGSI query has failed with status {}'.format(resp.status_code))
+
+        return resp
+
+    def count(self, params):
+        # Only the total count is requested, not the entities
+        query = dict(params)
+        query['limit'] = 1
+        query['options'] = _add_option(query.get('options'), 'count')
+
+        resp = self._get(query, 'count_entities')
+
+        try:
+            return int(resp.headers['Fiware-Total-Count'])
+        except (KeyError, ValueError):
+            raise PluginError('The NGSI server has not provided the number of entities')
+
+    def iter_pages(self, params, max_entities=None, page_len=NGSI_PROFILE_PAGE_SIZE):
+        # Yields the pages of entities with their size in bytes, up to max_entities,
+        # so the query result is never loaded at once
+        offset = 0
+
+        while max_entities is None or offset < max_entities:
+            limit = page_len if max_entities is None else min(page_len, max_entities - offset)
+
+            query = dict(params)
+            query['offset'] = offset
+            query['limit'] = limit
+
+            resp = self._get(query, 'list_entities')
+            entities = resp.json()
+
+            # There is no remaining entities
+            if not len(entities):
+                return
+
+            yield entities, len(resp.content)
+
+            if len(entities) < limit:
+                return
+
+            offset += len(entities)
+
+    def profile(self, params, sample_size=NGSI_PROFILE_SAMPLE_SIZE):
+        # Returns the number of entities of the query, the attributes found in a sample of them
+        # and the size of the whole result estimated from the size of the sample
+        entity_count = self.count(params)
+
+        attributes = set()
+        sampled = 0
+        sample_bytes = 0
+
+        for entities, size in self.iter_pages(params, max_entities=min(sample_size, entity_count)):
+            for entity in entities:
+                # Entities of the values and unique representations are lists without the attribute names
+                if isinstance(entity, dict):
+                    attributes.update(attr for attr in entity if attr not in ('id', 'type'))
+
+            sampled += len(entities)
+            sample_bytes += size
+
+        estimated_size = 0
+        if sampled:
+            estimated_size = int(float(sample_bytes) / sampled * entity_count)
+
+        return {
+            'entity_count': entity_count,
+            'attributes': sorted(attributes),
+            'sampled_entities': sampled,
+            'estimated_size': estimated_size
+        }
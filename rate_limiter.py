@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
+
+import metrics
+
+registry = metrics.registry
+registry.describe(
+    'ngsi_dataset_rate_limit_wait_seconds', 'histogram', 'Time calls waited for the outbound rate limiter')
+registry.describe(
+    'ngsi_dataset_rate_limit_overloads_total', 'counter', 'Responses telling that a backend is overloaded')
+
+
+def parse_retry_after(value):
+    # Retry-After headers include the seconds to wait or the date when the service is available
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+# Token bucket limiting the calls per second made to a backend, with up to `burst` calls made
+# at once, combined with a limit of concurrent calls that is adapted to the backend load (AIMD):
+# it is halved when the backend is overloaded and increased by one call per window of
+# successful calls, so the highest rate the backend can sustain is found again gradually
+class AdaptiveLimiter(object):
+
+    def __init__(self, name, kind, rate, burst, concurrency, max_wait):
+        self.name = name
+        self._labels = {'backend': name, 'kind': kind}
+        self._rate = float(rate)
+        self._burst = float(max(burst, 1))
+        self._max_concurrency = float(max(concurrency, 1))
+        self._max_wait = max_wait
+
+        self.reset()
+
+    @property
+    def concurrency(self):
+        return int(self._limit)
+
+    def reset(self):
+        self._cond = threading.Condition()
+        self._tokens = self._burst
+        self._refilled_at = time.time()
+        self._limit = self._max_concurrency
+        self._in_flight = 0
+        self._paused_until = 0
+
+    def _refill(self, now):
+        if self._rate > 0:
+            self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._rate)
+
+        self._refilled_at = now
+
+    def acquire(self):
+        start = time.time()
+        deadline = start + self._max_wait
+
+        with self._cond:
+            while True:
+                now = time.time()
+                self._refill(now)
+
+                if now < self._paused_until:
+                    # The backend has asked to wait with a Retry-After
+                    wait = self._paused_until - now
+                elif self._in_flight >= int(self._limit):
+                    # Wait for a running call to complete
+                    wait = deadline - now
+                elif self._rate > 0 and self._tokens < 1:
+                    wait = (1 - self._tokens) / self._rate
+                else:
+                    if self._rate > 0:
+                        self._tokens -= 1
+
+                    self._in_flight += 1
+                    break
+
+                if now >= deadline or now + wait > deadline:
+                    raise PluginError('The {} service is overloaded, please try again later'.format(self.name))
+
+                self._cond.wait(wait)
+
+        registry.observe('ngsi_dataset_rate_limit_wait_seconds', self._labels, time.time() - start)
+
+    def release(self, overloaded=False, retry_after=None):
+        # Calls that failed before reaching the backend are released with overloaded as None,
+        # leaving the concurrency limit as it is
+        with self._cond:
+            self._in_flight -= 1
+
+            if overloaded:
+                registry.inc('ngsi_dataset_rate_limit_overloads_total', self._labels)
+                self._limit = max(1.0, self._limit / 2)
+
+                if retry_after is not None:
+                    self._paused_until = max(self._paused_until, time.time() + retry_after)
+            elif overloaded is not None:
+                self._limit = min(self._max_concurrency, self._limit + 1 / self._limit)
+
+            self._cond.notify_all()
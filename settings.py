@@ -17,24 +17,175 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from os import environ
+from os import environ, path
 
 UNITS = [{
     'name': 'Api call',
     'description': 'The final price is calculated based on the number of calls made to the API'
 }]
 
+# Directory where the plugin keeps its local state (accounting marks, usage, job queues)
+DATA_DIR = path.join(path.dirname(path.abspath(__file__)), 'data')
+
 IDM_USER = 'idm'
 IDM_PASSWORD = 'idm'
 IDM_URL = 'http://idm.docker:5000'
 
+# Seconds before the IdM token expiry when it is proactively renewed
+IDM_TOKEN_REFRESH_MARGIN = 60
+# Token lifetime assumed when the IdM response does not include its expiry
+IDM_TOKEN_DEFAULT_TTL = 3600
+# Seconds the roles of an IdM application, and the roles assigned to its users, are cached
+IDM_ROLES_CACHE_TTL = 300
+IDM_ASSIGNMENTS_CACHE_TTL = 300
+# Concurrent role assignments made by bulk acquisitions and suspensions
+IDM_BULK_WORKERS = 10
+# Limits of the calls made to the IdM, separated for reads and writes (role assignments): calls
+# per second (0 for no limit), calls made at once when there has been no recent calls and
+# maximum concurrent calls, which is reduced while the IdM answers it is overloaded (429 or 5xx)
+IDM_READ_RATE = 100
+IDM_READ_BURST = 20
+IDM_READ_CONCURRENCY = 20
+IDM_WRITE_RATE = 50
+IDM_WRITE_BURST = 10
+IDM_WRITE_CONCURRENCY = 10
+# Retries of the calls rejected as the IdM is overloaded and maximum seconds a call waits
+# for the rate limiter before failing
+IDM_OVERLOAD_RETRIES = 3
+IDM_RATE_MAX_WAIT = 60
+
 UMBRELLA_URL = ''
 UMBRELLA_KEY = ''
 UMBRELLA_TOKEN = ''
 
+# Seconds after which the local index of API Umbrella APIs is refreshed in background with
+# the APIs updated since the last refresh, and seconds between complete reloads of the index
+UMBRELLA_INDEX_TTL = 60
+UMBRELLA_INDEX_FULL_REFRESH = 3600
+
+# Page size used when streaming API Umbrella analytics logs
+ACCOUNTING_PAGE_SIZE = 1000
+# Days of usage collected in the first accounting pull of a contract
+ACCOUNTING_MAX_DAYS = 31
+# Hourly usage counters kept per customer and app until they are billed (93 days)
+USAGE_STORE_BUCKETS = 24 * 93
+# The ledger of the accounting records sent to the billing is rewritten without the billed ones
+# when they take more than the given ratio of a file of at least the given size in bytes
+USAGE_LEDGER_COMPACT_RATIO = 0.5
+USAGE_LEDGER_COMPACT_MIN_SIZE = 1024 * 1024
+
+# Entities per page of the NGSI query URLs published as datasets, when the expression does not
+# include a limit, and whether the simplified keyValues representation is used by default
+NGSI_QUERY_PAGE_SIZE = 100
+NGSI_QUERY_KEY_VALUES = True
+
+# Seconds the characteristics of a product spec are known to be up to date after reading or
+# updating them, so repeated updates without changes do not reach the catalog
+CATALOG_SPEC_CACHE_TTL = 300
+
+# Profiling of the NGSI queries published as datasets: maximum number of entities sampled
+# to find their attributes and estimate the size of the result, and entities per request
+NGSI_PROFILE_SAMPLE_SIZE = 1000
+NGSI_PROFILE_PAGE_SIZE = 100
+
+# Background queue of CKAN operations: worker threads per process, attempts before a job
+# is marked as failed, base retry delay, polling interval and seconds before a running
+# job is considered abandoned by a dead worker
+CKAN_QUEUE_WORKERS = 2
+CKAN_QUEUE_MAX_ATTEMPTS = 8
+CKAN_QUEUE_RETRY_DELAY = 5
+CKAN_QUEUE_POLL_INTERVAL = 1
+CKAN_QUEUE_JOB_TIMEOUT = 600
+
+# Connection pooling of the outbound HTTP sessions (one pool per remote host)
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 20
+# Timeouts in seconds
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+# Retries of idempotent requests, with jittered exponential backoff
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+
+# Circuit breaker of every backend: it opens when the rate of failed calls (connection errors,
+# timeouts and 5xx responses) among the last CIRCUIT_WINDOW ones reaches CIRCUIT_FAILURE_RATE,
+# rejecting calls for CIRCUIT_OPEN_SECONDS before letting CIRCUIT_HALF_OPEN_CALLS probe calls
+CIRCUIT_FAILURE_RATE = 0.5
+CIRCUIT_MIN_CALLS = 10
+CIRCUIT_WINDOW = 20
+CIRCUIT_OPEN_SECONDS = 30
+CIRCUIT_HALF_OPEN_CALLS = 1
+
+# Whether every process logs in the IdM and loads the API Umbrella index in background when
+# the plugin is loaded, instead of doing it in the first hook
+CLIENT_WARMUP = False
+
+# Port of the Prometheus metrics endpoint (0 disables it) and whether the outbound calls
+# of every hook are logged as trace spans
+METRICS_PORT = 0
+METRICS_TRACE = False
+
 # =====================================================
 # READ environ to check if settings has to be overriden
 
+DATA_DIR = environ.get('BAE_ASSET_DATA_DIR', DATA_DIR)
+
 IDM_USER = environ.get('BAE_ASSET_IDM_USER', IDM_USER)
 IDM_PASSWORD = environ.get('BAE_ASSET_IDM_PASSWORD', IDM_PASSWORD)
 IDM_URL = environ.get('BAE_ASSET_IDM_URL', IDM_URL)
+IDM_TOKEN_REFRESH_MARGIN = int(environ.get('BAE_ASSET_IDM_TOKEN_REFRESH_MARGIN', IDM_TOKEN_REFRESH_MARGIN))
+IDM_TOKEN_DEFAULT_TTL = int(environ.get('BAE_ASSET_IDM_TOKEN_DEFAULT_TTL', IDM_TOKEN_DEFAULT_TTL))
+IDM_ROLES_CACHE_TTL = int(environ.get('BAE_ASSET_IDM_ROLES_CACHE_TTL', IDM_ROLES_CACHE_TTL))
+IDM_ASSIGNMENTS_CACHE_TTL = int(environ.get('BAE_ASSET_IDM_ASSIGNMENTS_CACHE_TTL', IDM_ASSIGNMENTS_CACHE_TTL))
+IDM_BULK_WORKERS = int(environ.get('BAE_ASSET_IDM_BULK_WORKERS', IDM_BULK_WORKERS))
+IDM_READ_RATE = float(environ.get('BAE_ASSET_IDM_READ_RATE', IDM_READ_RATE))
+IDM_READ_BURST = int(environ.get('BAE_ASSET_IDM_READ_BURST', IDM_READ_BURST))
+IDM_READ_CONCURRENCY = int(environ.get('BAE_ASSET_IDM_READ_CONCURRENCY', IDM_READ_CONCURRENCY))
+IDM_WRITE_RATE = float(environ.get('BAE_ASSET_IDM_WRITE_RATE', IDM_WRITE_RATE))
+IDM_WRITE_BURST = int(environ.get('BAE_ASSET_IDM_WRITE_BURST', IDM_WRITE_BURST))
+IDM_WRITE_CONCURRENCY = int(environ.get('BAE_ASSET_IDM_WRITE_CONCURRENCY', IDM_WRITE_CONCURRENCY))
+IDM_OVERLOAD_RETRIES = int(environ.get('BAE_ASSET_IDM_OVERLOAD_RETRIES', IDM_OVERLOAD_RETRIES))
+IDM_RATE_MAX_WAIT = float(environ.get('BAE_ASSET_IDM_RATE_MAX_WAIT', IDM_RATE_MAX_WAIT))
+
+UMBRELLA_URL = environ.get('BAE_ASSET_UMBRELLA_URL', UMBRELLA_URL)
+UMBRELLA_KEY = environ.get('BAE_ASSET_UMBRELLA_KEY', UMBRELLA_KEY)
+UMBRELLA_TOKEN = environ.get('BAE_ASSET_UMBRELLA_TOKEN', UMBRELLA_TOKEN)
+UMBRELLA_INDEX_TTL = int(environ.get('BAE_ASSET_UMBRELLA_INDEX_TTL', UMBRELLA_INDEX_TTL))
+UMBRELLA_INDEX_FULL_REFRESH = int(environ.get('BAE_ASSET_UMBRELLA_INDEX_FULL_REFRESH', UMBRELLA_INDEX_FULL_REFRESH))
+
+ACCOUNTING_PAGE_SIZE = int(environ.get('BAE_ASSET_ACCOUNTING_PAGE_SIZE', ACCOUNTING_PAGE_SIZE))
+ACCOUNTING_MAX_DAYS = int(environ.get('BAE_ASSET_ACCOUNTING_MAX_DAYS', ACCOUNTING_MAX_DAYS))
+USAGE_STORE_BUCKETS = int(environ.get('BAE_ASSET_USAGE_STORE_BUCKETS', USAGE_STORE_BUCKETS))
+USAGE_LEDGER_COMPACT_RATIO = float(environ.get('BAE_ASSET_USAGE_LEDGER_COMPACT_RATIO', USAGE_LEDGER_COMPACT_RATIO))
+USAGE_LEDGER_COMPACT_MIN_SIZE = int(environ.get('BAE_ASSET_USAGE_LEDGER_COMPACT_MIN_SIZE', USAGE_LEDGER_COMPACT_MIN_SIZE))
+
+CATALOG_SPEC_CACHE_TTL = int(environ.get('BAE_ASSET_CATALOG_SPEC_CACHE_TTL', CATALOG_SPEC_CACHE_TTL))
+
+NGSI_QUERY_PAGE_SIZE = int(environ.get('BAE_ASSET_NGSI_QUERY_PAGE_SIZE', NGSI_QUERY_PAGE_SIZE))
+NGSI_QUERY_KEY_VALUES = environ.get('BAE_ASSET_NGSI_QUERY_KEY_VALUES', str(NGSI_QUERY_KEY_VALUES)).lower() == 'true'
+NGSI_PROFILE_SAMPLE_SIZE = int(environ.get('BAE_ASSET_NGSI_PROFILE_SAMPLE_SIZE', NGSI_PROFILE_SAMPLE_SIZE))
+NGSI_PROFILE_PAGE_SIZE = int(environ.get('BAE_ASSET_NGSI_PROFILE_PAGE_SIZE', NGSI_PROFILE_PAGE_SIZE))
+
+CKAN_QUEUE_WORKERS = int(environ.get('BAE_ASSET_CKAN_QUEUE_WORKERS', CKAN_QUEUE_WORKERS))
+CKAN_QUEUE_MAX_ATTEMPTS = int(environ.get('BAE_ASSET_CKAN_QUEUE_MAX_ATTEMPTS', CKAN_QUEUE_MAX_ATTEMPTS))
+CKAN_QUEUE_RETRY_DELAY = float(environ.get('BAE_ASSET_CKAN_QUEUE_RETRY_DELAY', CKAN_QUEUE_RETRY_DELAY))
+CKAN_QUEUE_POLL_INTERVAL = float(environ.get('BAE_ASSET_CKAN_QUEUE_POLL_INTERVAL', CKAN_QUEUE_POLL_INTERVAL))
+CKAN_QUEUE_JOB_TIMEOUT = float(environ.get('BAE_ASSET_CKAN_QUEUE_JOB_TIMEOUT', CKAN_QUEUE_JOB_TIMEOUT))
+
+HTTP_POOL_CONNECTIONS = int(environ.get('BAE_ASSET_HTTP_POOL_CONNECTIONS', HTTP_POOL_CONNECTIONS))
+HTTP_POOL_MAXSIZE = int(environ.get('BAE_ASSET_HTTP_POOL_MAXSIZE', HTTP_POOL_MAXSIZE))
+HTTP_CONNECT_TIMEOUT = float(environ.get('BAE_ASSET_HTTP_CONNECT_TIMEOUT', HTTP_CONNECT_TIMEOUT))
+HTTP_READ_TIMEOUT = float(environ.get('BAE_ASSET_HTTP_READ_TIMEOUT', HTTP_READ_TIMEOUT))
+HTTP_MAX_RETRIES = int(environ.get('BAE_ASSET_HTTP_MAX_RETRIES', HTTP_MAX_RETRIES))
+HTTP_BACKOFF_FACTOR = float(environ.get('BAE_ASSET_HTTP_BACKOFF_FACTOR', HTTP_BACKOFF_FACTOR))
+
+CIRCUIT_FAILURE_RATE = float(environ.get('BAE_ASSET_CIRCUIT_FAILURE_RATE', CIRCUIT_FAILURE_RATE))
+CIRCUIT_MIN_CALLS = int(environ.get('BAE_ASSET_CIRCUIT_MIN_CALLS', CIRCUIT_MIN_CALLS))
+CIRCUIT_WINDOW = int(environ.get('BAE_ASSET_CIRCUIT_WINDOW', CIRCUIT_WINDOW))
+CIRCUIT_OPEN_SECONDS = float(environ.get('BAE_ASSET_CIRCUIT_OPEN_SECONDS', CIRCUIT_OPEN_SECONDS))
+CIRCUIT_HALF_OPEN_CALLS = int(environ.get('BAE_ASSET_CIRCUIT_HALF_OPEN_CALLS', CIRCUIT_HALF_OPEN_CALLS))
+
+CLIENT_WARMUP = environ.get('BAE_ASSET_CLIENT_WARMUP', str(CLIENT_WARMUP)).lower() == 'true'
+
+METRICS_PORT = int(environ.get('BAE_ASSET_METRICS_PORT', METRICS_PORT))
+METRICS_TRACE = environ.get('BAE_ASSET_METRICS_TRACE', str(METRICS_TRACE)).lower() == 'true'
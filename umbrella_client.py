@@ -19,12 +19,36 @@
 
 from __future__ import unicode_literals
 
+import calendar
+import json
 import requests
-from urlparse import urljoin
+import time
+from datetime import datetime
+from urllib import urlencode
+from urlparse import urljoin, urlparse
 
 from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 
-from settings import UMBRELLA_URL, UMBRELLA_KEY, UMBRELLA_TOKEN
+import http_client
+import metrics
+from umbrella_index import api_index, split_path
+from settings import UMBRELLA_URL, UMBRELLA_KEY, UMBRELLA_TOKEN, ACCOUNTING_PAGE_SIZE
+
+HOUR_MILLIS = 3600 * 1000
+
+
+def _to_millis(date):
+    return calendar.timegm(date.timetuple()) * 1000
+
+
+def _parse_request_at(request_at):
+    # Analytics logs include the request time as epoch millis or as an ISO 8601 UTC date
+    if isinstance(request_at, (int, long, float)):
+        return int(request_at)
+
+    date = datetime.strptime(request_at.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+    return _to_millis(date)
+
 
 class UmbrellaClient(object):
 
@@ -41,8 +65,8 @@ class UmbrellaClient(object):
         url = urljoin(self._server, path)
         try:
             resp = method(url, **kwargs)
-        except requests.ConnectionError:
-            raise PermissionDenied('Invalid resource: API Umbrella server is not responding')
+        except (requests.ConnectionError, requests.Timeout):
+            raise PluginError('Invalid resource: API Umbrella server is not responding')
 
         if resp.status_code == 404:
             raise PluginError('The provided Umbrella resource does not exist')
@@ -51,56 +75,55 @@ class UmbrellaClient(object):
 
         return resp
 
-    def _get_request(self, path):
-        resp = self._make_request(path, requests.get, headers={
-            'X-Api-Key': self._key,
-            'X-Admin-Auth-Token': self._token
-        }, verify=False)
+    def _get_request(self, path, operation):
+        with metrics.labels(service='umbrella', operation=operation):
+            resp = self._make_request(path, http_client.get, headers={
+                'X-Api-Key': self._key,
+                'X-Admin-Auth-Token': self._token
+            }, verify=False)
 
         return resp.json()
 
-    def _paginate_data(self, url, err_msg, page_processor):
-        page_len = 100
+    def _iter_pages(self, url, operation, page_len=100):
         start = 0
-        processed = False
-        matching_elem = None
+        separator = '&' if '?' in url else '?'
 
-        while not processed:
-            result = self._get_request(url + '&start={}&length={}'.format(start, page_len))
+        while True:
+            result = self._get_request(url + separator + 'start={}&length={}'.format(start, page_len), operation)
 
             # There is no remaining elements
             if not len(result['data']):
-                raise PluginError(err_msg)
-            
-            for elem in result['data']:
-                processed = page_processor(elem)
-
-                # The page element has been found
-                if processed:
-                    matching_elem = elem
-                    break
-            
+                return
+
+            yield result
+
+            if len(result['data']) < page_len:
+                return
+
             start += page_len
 
-        return matching_elem
+    def iter_api_pages(self, newest_first=False):
+        url = '/api-umbrella/v1/apis.json'
+        if newest_first:
+            url += '?columns[0][data]=updated_at&order[0][column]=0&order[0][dir]=desc'
+
+        return self._iter_pages(url, 'list_apis')
 
     def validate_service(self, path):
         err_msg = 'The provided asset is not supported. ' \
                   'Only services protected by API Umbrella are supported'
 
         # Split the path of the service 
-        paths = [p for p in path.split('/') if p != '']
+        paths = split_path(path)
         if not len(paths):
             # API umbrella resources include a path for matching the service
             raise PluginError(err_msg)
 
-        # Make paginated requests to API umbrella looking for the provided paths
-        url = '/api-umbrella/v1/apis.json?search[value]={}&search[regex]=false'.format(paths[0])
-        def page_processor(api):
-            front_path = [p for p in api['frontend_prefixes'].split('/') if p != '']
-            return len(front_path) <= len(paths) and front_path == paths[:len(front_path)]
+        # Look for the API with the longest frontend prefix matching the provided path
+        matching_elem = api_index.match(path, self)
 
-        matching_elem = self._paginate_data(url, err_msg, page_processor)
+        if matching_elem is None:
+            raise PluginError(err_msg)
 
         # If the API is configured to accept access tokens from an external IDP save its external id
         app_id = None
@@ -109,5 +132,114 @@ class UmbrellaClient(object):
 
         return app_id
 
+    def _request_at_rule(self, operator, value):
+        return {
+            'id': 'request_at',
+            'field': 'request_at',
+            'type': 'integer',
+            'input': 'number',
+            'operator': operator,
+            'value': value
+        }
+
+    def iter_logs(self, query, since, until, page_len=ACCOUNTING_PAGE_SIZE):
+        # Yields the request time and the log of the calls made after since and up to until, sorted by
+        # request time. Instead of paging by offset, every page is requested from the time of the last
+        # log read, skipping the logs of that same time already read
+        bound = since
+        operator = 'greater'
+        skip = 0
+
+        while True:
+            rules = query['rules'] + [
+                self._request_at_rule(operator, bound), self._request_at_rule('less_or_equal', until)]
+            params = {
+                'start_at': datetime.utcfromtimestamp(since / 1000).date().isoformat(),
+                'end_at': datetime.utcfromtimestamp(until / 1000).date().isoformat(),
+                'query': json.dumps(dict(query, rules=rules)),
+                'start': skip,
+                'length': page_len
+            }
+
+            url = '/api-umbrella/v1/analytics/logs.json?' + urlencode(params) + \
+                '&columns[0][data]=request_at&order[0][column]=0&order[0][dir]=asc'
+
+            logs = self._get_request(url, 'analytics_logs')['data']
+
+            for log in logs:
+                request_at = _parse_request_at(log['request_at'])
+
+                if operator == 'greater' or request_at != bound:
+                    operator = 'greater_or_equal'
+                    bound = request_at
+                    skip = 0
+
+                skip += 1
+                yield request_at, log
+
+            if len(logs) < page_len:
+                return
+
     def _process_call_accounting(self, params, parsed_url):
-        pass
+        # Yields the number of calls of every hour with the time of its last call
+        hour = None
+        calls = 0
+        last_request = None
+
+        for request_at, log in self.iter_logs(params['query'], params['since'], params['until']):
+            # Logs are sorted by request time
+            if request_at // HOUR_MILLIS != hour:
+                if calls > 0:
+                    yield hour, calls, last_request
+
+                hour = request_at // HOUR_MILLIS
+                calls = 0
+
+            calls += 1
+            last_request = request_at
+
+        if calls > 0:
+            yield hour, calls, last_request
+
+    def get_accounting(self, email, url, since, unit):
+        unit = unit.lower()
+        if unit not in self._accounting_processor:
+            raise PluginError('Unsupported accounting unit ' + unit)
+
+        parsed_url = urlparse(url)
+
+        # Only the calls of the customer to the asset API authorized by API Umbrella are accounted
+        query = {
+            'condition': 'AND',
+            'rules': [{
+                'id': 'user_email',
+                'field': 'user_email',
+                'type': 'string',
+                'input': 'text',
+                'operator': 'equal',
+                'value': email
+            }, {
+                'id': 'request_path',
+                'field': 'request_path',
+                'type': 'string',
+                'input': 'text',
+                'operator': 'begins_with',
+                'value': parsed_url.path
+            }, {
+                'id': 'gatekeeper_denied_code',
+                'field': 'gatekeeper_denied_code',
+                'type': 'string',
+                'input': 'select',
+                'operator': 'is_null',
+                'value': None
+            }],
+            'valid': True
+        }
+
+        params = {
+            'since': since,
+            'until': int(time.time() * 1000),
+            'query': query
+        }
+
+        return self._accounting_processor[unit](params, parsed_url)
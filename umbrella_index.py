@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+import metrics
+from concurrency import flights
+from settings import UMBRELLA_INDEX_TTL, UMBRELLA_INDEX_FULL_REFRESH
+
+logger = logging.getLogger(__name__)
+
+
+def split_path(path):
+    return [p for p in path.split('/') if p != '']
+
+
+def _get_prefixes(api):
+    # API listings include the frontend prefixes of all the URL matches separated by commas
+    prefixes = api.get('frontend_prefixes') or ''
+    return [split_path(prefix.strip()) for prefix in prefixes.split(',')]
+
+
+class _TrieNode(object):
+
+    __slots__ = ('children', 'api_ids')
+
+    def __init__(self):
+        self.children = {}
+        self.api_ids = set()
+
+
+# Path segment trie of API frontend prefixes
+class PrefixTrie(object):
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    def insert(self, segments, api_id):
+        node = self._root
+        for segment in segments:
+            node = node.children.setdefault(segment, _TrieNode())
+
+        node.api_ids.add(api_id)
+
+    def remove(self, segments, api_id):
+        node = self._root
+        visited = []
+        for segment in segments:
+            if segment not in node.children:
+                return
+
+            visited.append((node, segment))
+            node = node.children[segment]
+
+        node.api_ids.discard(api_id)
+
+        # Prune the branches that do not lead to any API
+        for parent, segment in reversed(visited):
+            child = parent.children[segment]
+            if child.api_ids or child.children:
+                break
+
+            del parent.children[segment]
+
+    def longest_match(self, segments):
+        node = self._root
+        matching = node.api_ids
+
+        for segment in segments:
+            node = node.children.get(segment)
+            if node is None:
+                break
+
+            if node.api_ids:
+                matching = node.api_ids
+
+        return matching
+
+
+class ApiIndex(object):
+
+    def __init__(self, ttl=UMBRELLA_INDEX_TTL, full_refresh=UMBRELLA_INDEX_FULL_REFRESH):
+        self._ttl = ttl
+        self._full_refresh = full_refresh
+
+        self._lock = threading.Lock()
+
+        self._trie = PrefixTrie()
+        self._apis = {}
+        self._high_water = None
+        self._refreshed_at = None
+        self._loaded_at = None
+
+    def reset(self):
+        # The loaded index is kept, only the lock may be held by a thread of the parent process
+        self._lock = threading.Lock()
+
+    def _compact(self, api):
+        # Only the info needed for matching and validating the services is kept
+        return {
+            'id': api['id'],
+            'frontend_prefixes': api.get('frontend_prefixes'),
+            'settings': api.get('settings') or {},
+            'updated_at': api.get('updated_at')
+        }
+
+    def _upsert(self, api):
+        previous = self._apis.get(api['id'])
+        if previous is not None:
+            for prefix in _get_prefixes(previous):
+                self._trie.remove(prefix, previous['id'])
+
+        self._apis[api['id']] = api
+        for prefix in _get_prefixes(api):
+            self._trie.insert(prefix, api['id'])
+
+        if api['updated_at'] is not None and (self._high_water is None or api['updated_at'] > self._high_water):
+            self._high_water = api['updated_at']
+
+    def _full_load(self, client):
+        trie = PrefixTrie()
+        apis = {}
+        high_water = None
+
+        for page in client.iter_api_pages():
+            for elem in page['data']:
+                api = self._compact(elem)
+                apis[api['id']] = api
+
+                for prefix in _get_prefixes(api):
+                    trie.insert(prefix, api['id'])
+
+                if api['updated_at'] is not None and (high_water is None or api['updated_at'] > high_water):
+                    high_water = api['updated_at']
+
+        with self._lock:
+            self._trie = trie
+            self._apis = apis
+            self._high_water = high_water
+            self._loaded_at = self._refreshed_at = time.time()
+
+    def _incremental_load(self, client):
+        # APIs are retrieved from the most recently updated, so only the ones
+        # modified since the last refresh are downloaded
+        high_water = self._high_water
+        total = None
+
+        for page in client.iter_api_pages(newest_first=True):
+            total = page.get('recordsTotal', total)
+            outdated = False
+
+            with self._lock:
+                for elem in page['data']:
+                    if elem.get('updated_at') is None:
+                        return False
+
+                    if elem['updated_at'] < high_water:
+                        outdated = True
+                        break
+
+                    self._upsert(self._compact(elem))
+
+            if outdated:
+                break
+
+        with self._lock:
+            self._refreshed_at = time.time()
+
+            # Deleted APIs are not included in the listing, if the number of
+            # APIs does not match the index needs to be fully reloaded
+            return total is None or total == len(self._apis)
+
+    def _refresh(self, client):
+        if self._loaded_at is None or self._high_water is None \
+                or time.time() - self._loaded_at >= self._full_refresh:
+            self._full_load(client)
+
+        elif not self._incremental_load(client):
+            self._full_load(client)
+
+    def refresh(self, client, blocking=True):
+        # Concurrent refreshes wait for the one in progress and share its result
+        key = ('umbrella_index', id(self))
+        if not blocking and flights.in_flight(key):
+            return
+
+        flights.do(key, lambda: self._refresh(client))
+
+    def _background_refresh(self, client):
+        try:
+            self.refresh(client, blocking=False)
+        except Exception:
+            logger.exception('Error refreshing the API Umbrella index, the current one is kept')
+
+    def _lookup(self, segments):
+        with self._lock:
+            api_ids = self._trie.longest_match(segments)
+
+            if not api_ids:
+                return None
+
+            return self._apis[min(api_ids)]
+
+    def is_stale(self):
+        return self._refreshed_at is None or time.time() - self._refreshed_at >= self._ttl
+
+    def match(self, path, client):
+        segments = split_path(path)
+
+        refreshed = False
+        if self._loaded_at is None:
+            self.refresh(client)
+            refreshed = True
+
+        elif self.is_stale():
+            thread = threading.Thread(target=metrics.bind(self._background_refresh), args=(client,))
+            thread.daemon = True
+            thread.start()
+
+        api = self._lookup(segments)
+        if api is None and not refreshed:
+            # The API may have been registered after the last refresh
+            self.refresh(client)
+            api = self._lookup(segments)
+
+        return api
+
+
+api_index = ApiIndex()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+from settings import DATA_DIR, USAGE_LEDGER_COMPACT_RATIO, USAGE_LEDGER_COMPACT_MIN_SIZE
+
+
+# Every entry of the ledger file is a JSON document preceded by its length and CRC, so an
+# entry partially written by a crashed process is detected and discarded. Entries are:
+#  - record: an accounting record produced for a contract and period, with its dedup id
+#  - batch: commits the records produced by a pull, with the contract last usage seen then
+#  - billed: the batches of the contract up to the given one, and so the usage until the given
+#    hour, have been billed
+_ENTRY = struct.Struct(str('<II'))
+
+
+def get_dedup_id(contract, start_hour, end_hour):
+    return hashlib.sha1('{}:{}:{}'.format(contract, start_hour, end_hour).encode('utf-8')).hexdigest()
+
+
+class UsageLedger(object):
+
+    def __init__(self, ledger_dir=None, compact_ratio=USAGE_LEDGER_COMPACT_RATIO,
+                 compact_min_size=USAGE_LEDGER_COMPACT_MIN_SIZE):
+
+        self._dir = ledger_dir or os.path.join(DATA_DIR, 'usage')
+        self._compact_ratio = compact_ratio
+        self._compact_min_size = compact_min_size
+
+        self._lock = threading.RLock()
+        self._fd = None
+        self._lock_fd = None
+        self._mmap = None
+        self._reset_index()
+
+    def _reset_index(self):
+        self._scanned = 0
+        self._committed = 0
+        self._contracts = {}
+        self._dead_bytes = 0
+
+    def _path(self):
+        return os.path.join(self._dir, 'usage.ledger')
+
+    def _open_lock(self):
+        if self._lock_fd is not None:
+            return
+
+        if not os.path.isdir(self._dir):
+            try:
+                os.makedirs(self._dir)
+            except OSError:
+                # Created by another worker
+                if not os.path.isdir(self._dir):
+                    raise
+
+        self._lock_fd = os.open(os.path.join(self._dir, 'usage.ledger.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _open(self):
+        # The file is replaced when another worker compacts it
+        if self._fd is not None and os.fstat(self._fd).st_ino != os.stat(self._path()).st_ino:
+            self._close()
+
+        if self._fd is None:
+            self._fd = os.open(self._path(), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+            self._reset_index()
+
+    def reset(self):
+        # File locks are shared with the parent process through the inherited descriptors
+        self._lock = threading.RLock()
+        if self._fd is not None:
+            self._close()
+
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+        self._reset_index()
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+        os.close(self._fd)
+        self._fd = None
+
+    @contextmanager
+    def _file_lock(self):
+        # The ledger is shared by all the worker processes of the server
+        with self._lock:
+            self._open_lock()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                self._open()
+                self._catch_up()
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _get_contract(self, contract):
+        return self._contracts.setdefault(contract, {
+            'billed': 0, 'billed_until': 0, 'batches': {}, 'pending': {}, 'ids': set()})
+
+    def _read(self, offset):
+        length = _ENTRY.unpack_from(self._mmap, offset)[0]
+        start = offset + _ENTRY.size
+        return json.loads(self._mmap[start:start + length].decode('utf-8'))
+
+    def _catch_up(self):
+        # Indexes the entries appended since the last scan, including the ones of other workers
+        size = os.fstat(self._fd).st_size
+        if size <= self._scanned:
+            return
+
+        if self._mmap is not None:
+            self._mmap.close()
+
+        self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+
+        offset = self._scanned
+        while offset + _ENTRY.size <= size:
+            length, crc = _ENTRY.unpack_from(self._mmap, offset)
+            end = offset + _ENTRY.size + length
+
+            # Entry being written or left incomplete by a crash
+            if end > size or zlib.crc32(self._mmap[offset + _ENTRY.size:end]) & 0xffffffff != crc:
+                break
+
+            self._index_entry(self._read(offset), offset, end - offset)
+            offset = end
+
+        self._scanned = offset
+
+    def _index_entry(self, entry, offset, size):
+        state = self._get_contract(entry['contract'])
+
+        if entry['type'] == 'record':
+            # Records are not considered until their batch is committed
+            state['pending'].setdefault(entry['batch'], []).append((offset, size, entry['id']))
+            return
+
+        if entry['type'] == 'batch':
+            records = state['pending'].pop(entry['batch'], [])
+            state['ids'].update(dedup_id for record_offset, record_size, dedup_id in records)
+            state['batches'][entry['batch']] = {
+                'observed': entry['observed'],
+                'end_hour': entry['end_hour'],
+                'entries': [(record_offset, record_size) for record_offset, record_size, dedup_id in records] +
+                           [(offset, size)]
+            }
+
+        elif entry['type'] == 'billed':
+            for batch in [batch for batch in state['batches'] if batch <= entry['batch']]:
+                entries = state['batches'].pop(batch)['entries']
+                self._dead_bytes += sum(entry_size for entry_offset, entry_size in entries)
+
+            state['billed'] = max(state['billed'], entry['batch'])
+            state['billed_until'] = max(state['billed_until'], entry['end_hour'])
+            self._dead_bytes += size
+
+        self._committed = offset + size
+
+    def _append(self, entries):
+        # Entries of a batch left incomplete by a crashed worker are discarded
+        if os.fstat(self._fd).st_size > self._committed:
+            os.ftruncate(self._fd, self._committed)
+            self._scanned = self._committed
+
+            for state in self._contracts.values():
+                state['pending'] = {}
+
+        data = b''
+        for entry in entries:
+            payload = json.dumps(entry).encode('utf-8')
+            data += _ENTRY.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+        os.write(self._fd, data)
+        os.fsync(self._fd)
+        self._catch_up()
+
+    def get_pending(self, contract):
+        # Returns the last batch of records of the contract not billed yet, or None
+        with self._file_lock():
+            state = self._contracts.get(contract)
+            if state is None:
+                return None
+
+            pending = [batch for batch in state['batches'] if batch > state['billed']]
+            if not len(pending):
+                return None
+
+            batch = state['batches'][max(pending)]
+            entries = [self._read(offset) for offset, size in batch['entries']]
+
+            return {
+                'batch': max(pending),
+                'observed': batch['observed'],
+                'end_hour': batch['end_hour'],
+                'records': [entry['record'] for entry in entries if entry['type'] == 'record']
+            }
+
+    def append_batch(self, contract, observed, end_hour, records):
+        # Saves the (start_hour, end_hour, record) records produced by a pull of the contract usage,
+        # records of a period already in the ledger are not saved again. Returns the saved records
+        with self._file_lock():
+            state = self._get_contract(contract)
+            batch = max([state['billed']] + list(state['batches'])) + 1
+
+            entries = []
+            for start_hour, record_end, record in records:
+                dedup_id = get_dedup_id(contract, start_hour, record_end)
+
+                # Usage already saved or billed, the ids of the billed records are removed by compaction
+                if dedup_id in state['ids'] or start_hour < state['billed_until']:
+                    continue
+
+                entries.append({
+                    'type': 'record',
+                    'contract': contract,
+                    'batch': batch,
+                    'id': dedup_id,
+                    'period': [start_hour, record_end],
+                    'record': record
+                })
+
+            if not len(entries):
+                return []
+
+            entries.append({
+                'type': 'batch',
+                'contract': contract,
+                'batch': batch,
+                'observed': observed,
+                'end_hour': end_hour
+            })
+
+            self._append(entries)
+            return [entry['record'] for entry in entries if entry['type'] == 'record']
+
+    def mark_billed(self, contract, batch):
+        with self._file_lock():
+            state = self._get_contract(contract)
+            end_hour = state['batches'][batch]['end_hour'] if batch in state['batches'] else 0
+
+            self._append([{
+                'type': 'billed',
+                'contract': contract,
+                'batch': batch,
+                'end_hour': end_hour
+            }])
+
+            self._compact()
+
+    def _compact(self):
+        # Rewrites the ledger without the billed records when they are most of the file
+        size = os.fstat(self._fd).st_size
+        if size < self._compact_min_size or self._dead_bytes < size * self._compact_ratio:
+            return
+
+        data = b''
+        for contract, state in self._contracts.items():
+            if not state['billed'] and not len(state['batches']):
+                continue
+
+            payload = json.dumps({
+                'type': 'billed', 'contract': contract, 'batch': state['billed'], 'end_hour': state['billed_until']
+            }).encode('utf-8')
+            data += _ENTRY.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+            for batch in sorted(state['batches']):
+                for offset, entry_size in state['batches'][batch]['entries']:
+                    data += self._mmap[offset:offset + entry_size]
+
+        tmp_path = self._path() + '.tmp'
+        with open(tmp_path, 'wb') as ledger_file:
+            ledger_file.write(data)
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+
+        os.rename(tmp_path, self._path())
+
+        self._close()
+        self._open()
+        self._catch_up()
+
+
+usage_ledger = UsageLedger()
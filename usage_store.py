@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of BAE NGSI Dataset plugin.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
+
+from settings import DATA_DIR, USAGE_STORE_BUCKETS
+
+
+# Every series (customer, app) has a fixed size slot in the data file including its header,
+# the first hour not yet billed and the mark of the last accounted request (epoch millis),
+# followed by a ring of hourly counters starting at the first unbilled hour
+_HEADER = struct.Struct(str('<QQ'))
+_COUNTER = struct.Struct(str('<Q'))
+
+
+class UsageWindowFull(PluginError):
+    pass
+
+
+class UsageStore(object):
+
+    def __init__(self, store_dir=None, buckets=USAGE_STORE_BUCKETS):
+        self._dir = store_dir or os.path.join(DATA_DIR, 'usage')
+        self._buckets = buckets
+        self._slot_size = _HEADER.size + _COUNTER.size * buckets
+
+        self._lock = threading.RLock()
+        self._fd = None
+        self._mmap = None
+        self._index = {'customers': {}, 'apps': {}, 'series': {}}
+
+    def _open(self):
+        if self._fd is not None:
+            return
+
+        if not os.path.isdir(self._dir):
+            try:
+                os.makedirs(self._dir)
+            except OSError:
+                # Created by another worker
+                if not os.path.isdir(self._dir):
+                    raise
+
+        self._fd = os.open(os.path.join(self._dir, 'usage.dat'), os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock_fd = os.open(os.path.join(self._dir, 'usage.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        self._load_index()
+
+    @contextmanager
+    def _file_lock(self):
+        # The store is shared by all the worker processes of the server
+        with self._lock:
+            self._open()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _index_path(self):
+        return os.path.join(self._dir, 'usage.idx')
+
+    def _load_index(self):
+        if os.path.exists(self._index_path()):
+            with open(self._index_path(), 'rb') as index_file:
+                self._index = json.loads(index_file.read().decode('utf-8'))
+
+    def _save_index(self):
+        tmp_path = self._index_path() + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(json.dumps(self._index).encode('utf-8'))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+        os.rename(tmp_path, self._index_path())
+
+    def _map(self, size):
+        if self._mmap is not None and len(self._mmap) >= size:
+            return
+
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+
+        if self._mmap is not None:
+            self._mmap.close()
+
+        self._mmap = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+
+    def _intern(self, table, name):
+        ids = self._index[table]
+        if name not in ids:
+            ids[name] = len(ids)
+
+        return ids[name]
+
+    def _get_slot(self, customer, app, create=False):
+        key = '{}:{}'.format(self._index['customers'].get(customer), self._index['apps'].get(app))
+
+        if key not in self._index['series']:
+            # The series may have been created by other worker
+            self._load_index()
+            key = '{}:{}'.format(self._index['customers'].get(customer), self._index['apps'].get(app))
+
+        if key not in self._index['series']:
+            if not create:
+                return None
+
+            key = '{}:{}'.format(self._intern('customers', customer), self._intern('apps', app))
+            self._index['series'][key] = len(self._index['series'])
+            self._map(len(self._index['series']) * self._slot_size)
+            self._save_index()
+
+        slot = self._index['series'][key] * self._slot_size
+        self._map(slot + self._slot_size)
+        return slot
+
+    def _counter_offset(self, slot, hour):
+        return slot + _HEADER.size + _COUNTER.size * (hour % self._buckets)
+
+    def get_mark(self, customer, app):
+        with self._file_lock():
+            slot = self._get_slot(customer, app)
+            if slot is None:
+                return None
+
+            base, mark = _HEADER.unpack_from(self._mmap, slot)
+            return mark or None
+
+    def add(self, customer, app, hour, count, mark):
+        with self._file_lock():
+            slot = self._get_slot(customer, app, create=True)
+            base, last_mark = _HEADER.unpack_from(self._mmap, slot)
+
+            # Usage already accounted, e.g. when a pull is repeated after a restart
+            if mark <= last_mark:
+                return False
+
+            if not base:
+                base = hour
+
+            # The usage is not accounted, so the pull can be resumed from the mark once the window is billed
+            if hour >= base + self._buckets:
+                raise UsageWindowFull('The usage store window is full, pending usage needs to be billed')
+
+            # Usage of already billed hours cannot be charged anymore
+            if hour >= base:
+                offset = self._counter_offset(slot, hour)
+                _COUNTER.pack_into(self._mmap, offset, _COUNTER.unpack_from(self._mmap, offset)[0] + count)
+
+            _HEADER.pack_into(self._mmap, slot, base, mark)
+            return True
+
+    def _sum(self, slot, start, end):
+        if start >= end:
+            return 0
+
+        # The range can wrap around the end of the ring
+        first = start % self._buckets
+        length = end - start
+        head = min(length, self._buckets - first)
+
+        offset = slot + _HEADER.size
+        total = sum(struct.unpack_from(str('<{}Q'.format(head)), self._mmap, offset + _COUNTER.size * first))
+
+        if length > head:
+            total += sum(struct.unpack_from(str('<{}Q'.format(length - head)), self._mmap, offset))
+
+        return total
+
+    def sum(self, customer, app, start_hour, end_hour):
+        with self._file_lock():
+            slot = self._get_slot(customer, app)
+            if slot is None:
+                return 0
+
+            base = _HEADER.unpack_from(self._mmap, slot)[0]
+            if not base:
+                return 0
+
+            return self._sum(slot, max(start_hour, base), min(end_hour, base + self._buckets))
+
+    def get_first_hour(self, customer, app):
+        with self._file_lock():
+            slot = self._get_slot(customer, app)
+            if slot is None:
+                return None
+
+            return _HEADER.unpack_from(self._mmap, slot)[0] or None
+
+    def get_window_end(self, customer, app):
+        # First hour that does not fit in the ring of the series
+        first_hour = self.get_first_hour(customer, app)
+        if first_hour is None:
+            return None
+
+        return first_hour + self._buckets
+
+    def compact(self, customer, app, until_hour):
+        # Billed hours are released so their counters can be reused
+        with self._file_lock():
+            slot = self._get_slot(customer, app)
+            if slot is None:
+                return
+
+            base, mark = _HEADER.unpack_from(self._mmap, slot)
+            if not base or until_hour <= base:
+                return
+
+            for hour in range(base, min(until_hour, base + self._buckets)):
+                _COUNTER.pack_into(self._mmap, self._counter_offset(slot, hour), 0)
+
+            _HEADER.pack_into(self._mmap, slot, until_hour, mark)
+            self._mmap.flush()
+
+    def reset(self):
+        # File locks are shared with the parent process through the inherited descriptors
+        self._lock = threading.RLock()
+
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+        if self._fd is not None:
+            os.close(self._fd)
+            os.close(self._lock_fd)
+            self._fd = None
+
+    def flush(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.flush()
+
+
+usage_store = UsageStore()